@@ -8,11 +8,37 @@ import shutil
 import threading
 import queue as Queue
 from queue import Empty as QueueEmpty
-import time
 from pathlib import Path
 from datetime import datetime
 import signal
 import json
+import sys
+from bisect import bisect_left
+from collections import Counter
+
+# 任务类型的显示/调度顺序
+TASK_TYPE_ORDER = {
+    "subtitle_process": 1,
+    "subtitle_cleanup": 2,
+    "audio": 3,
+    "video_plan": 4,
+    "video_chunk": 5,
+    "video": 6,
+    "video_fanout": 6,
+    "merge": 7,
+    "mux": 8,
+    "hardsub_chs": 9,
+    "hardsub_cht": 10,
+    "hardsub_chs_merge": 11,
+    "hardsub_cht_merge": 12,
+    "organize": 13
+}
+
+def task_sort_key(task):
+    task_type = task.task_type
+    if task_type.startswith("video_chunk_"):
+        task_type = "video_chunk"
+    return (int(task.episode_num), TASK_TYPE_ORDER.get(task_type, 999), task.task_type)
 
 class EncodingTask:
     def __init__(self, episode_num, task_type, command, prerequisites=None, work_dir=None):
@@ -28,6 +54,21 @@ class EncodingTask:
         self.custom_params = {}
         self.paused = False
         self.work_dir = work_dir
+
+    @property
+    def resource_class(self):
+        """任务占用的资源类别，用于限制同类任务的并发数"""
+        if self.task_type == "video" and self.custom_params.get("chunked"):
+            return "other"  # 分块模式下只负责拼接
+        if self.task_type.startswith("video_chunk_") or self.task_type == "video_fanout":
+            return "x265"
+        if self.task_type == "video" or ("hardsub_" in self.task_type and "merge" not in self.task_type):
+            return "x265"
+        if self.task_type == "audio":
+            return "ffmpeg"
+        if self.task_type in ("merge", "mux") or ("hardsub_" in self.task_type and "merge" in self.task_type):
+            return "mkvmerge"
+        return "other"
     
     def is_completed(self, root_path):
         if self.status == "stopped":
@@ -39,6 +80,20 @@ class EncodingTask:
         try:
             if self.task_type == "video":
                 return (episode_dir / "video.mkv").exists()
+
+            elif self.task_type == "video_fanout":
+                return all([
+                    (episode_dir / "video.mkv").exists(),
+                    (episode_dir / "chs.mkv").exists(),
+                    (episode_dir / "cht.mkv").exists()
+                ])
+
+            elif self.task_type == "video_plan":
+                return (episode_dir / "video_info.txt").exists()
+
+            elif self.task_type.startswith("video_chunk_"):
+                # 拼接完成后块文件会被删除
+                return Path(self.custom_params["output_chunk"]).exists() or (episode_dir / "video.mkv").exists()
                 
             elif self.task_type == "audio":
                 return (episode_dir / f"output{self.episode_num}.flac").exists()
@@ -89,6 +144,20 @@ class EncodingProject:
         }
         self.current_normal_x265_params = self.default_normal_x265_params.copy()
         self.current_hardsub_x265_params = self.default_hardsub_x265_params.copy()
+        # 每类资源同时运行的任务数上限，0 表示不限制
+        self.default_resource_limits = {
+            "x265": 2,
+            "ffmpeg": 4,
+            "mkvmerge": 2,
+            "other": 4
+        }
+        self.resource_limits = self.default_resource_limits.copy()
+        # 视频分块编码的块数，1 表示不分块
+        self.video_chunks = 1
+        # 断点续编的分段帧数，0 表示不分段（分段会在段首插入 IDR 帧并重置码率控制，默认关闭）
+        self.checkpoint_frames = 0
+        # 单次解码同时输出普通和硬字幕编码
+        self.use_fanout = False
         self.episode_params = {}
         self.use_move_mode = False
         self.params_file = None
@@ -109,6 +178,10 @@ class EncodingProject:
                 "normal": self.current_normal_x265_params,
                 "hardsub": self.current_hardsub_x265_params
             },
+            "resource_limits": self.resource_limits,
+            "video_chunks": self.video_chunks,
+            "checkpoint_frames": self.checkpoint_frames,
+            "use_fanout": self.use_fanout,
             "episodes": self.episode_params
         }
         
@@ -143,6 +216,29 @@ class EncodingProject:
                         if key in loaded_hardsub:
                             self.current_hardsub_x265_params[key] = loaded_hardsub[key]
             
+            # 加载并发限制
+            if "resource_limits" in params_data:
+                for key, value in params_data["resource_limits"].items():
+                    try:
+                        self.resource_limits[key] = int(value)
+                    except (ValueError, TypeError):
+                        pass
+
+            if "video_chunks" in params_data:
+                try:
+                    self.video_chunks = max(1, int(params_data["video_chunks"]))
+                except (ValueError, TypeError):
+                    pass
+
+            if "checkpoint_frames" in params_data:
+                try:
+                    self.checkpoint_frames = max(0, int(params_data["checkpoint_frames"]))
+                except (ValueError, TypeError):
+                    pass
+
+            if "use_fanout" in params_data:
+                self.use_fanout = bool(params_data["use_fanout"])
+
             # 加载单集参数
             if "episodes" in params_data:
                 self.episode_params = params_data["episodes"]
@@ -150,6 +246,10 @@ class EncodingProject:
             print("Loaded encoding parameters:")  # 调试输出
             print("Normal:", self.current_normal_x265_params)
             print("Hardsub:", self.current_hardsub_x265_params)
+            print("Resource limits:", self.resource_limits)
+            print("Video chunks:", self.video_chunks)
+            print("Checkpoint frames:", self.checkpoint_frames)
+            print("Use fanout:", self.use_fanout)
             print("Episodes:", self.episode_params)
             
         except Exception as e:
@@ -493,25 +593,30 @@ class EncodingProject:
         tasks.append(audio_task)
 
         # 视频任务
-        video_task = EncodingTask(
-            episode_num,
-            "video",
-            None,  # 命令先设为None，运行时再构造
-            work_dir=str(episode_dir)
-        )
-        video_task.custom_params = {
-            "input_vpy": str(episode_dir / f"{episode_num.zfill(2)}.vpy"),
-            "output_mkv": str(episode_dir / "video.mkv"),
-            "is_hardsub": False
-        }
-        tasks.append(video_task)
+        if self.use_fanout:
+            tasks.append(self._generate_fanout_task(episode_num))
+        elif self.video_chunks > 1:
+            tasks.extend(self._generate_chunked_video_tasks(episode_num, source_path))
+        else:
+            video_task = EncodingTask(
+                episode_num,
+                "video",
+                None,  # 命令先设为None，运行时再构造
+                work_dir=str(episode_dir)
+            )
+            video_task.custom_params = {
+                "input_vpy": str(episode_dir / f"{episode_num.zfill(2)}.vpy"),
+                "output_mkv": str(episode_dir / "video.mkv"),
+                "is_hardsub": False
+            }
+            tasks.append(video_task)
 
         # 合并任务
         merge_task = EncodingTask(
             episode_num,
             "merge",
             f'mkvmerge -o "{str(episode_dir / "final_output.mkv")}" --language 0:ja "{str(episode_dir / "video.mkv")}" "{str(episode_dir / f"output{episode_num}.flac")}"',
-            prerequisites=["audio", "video"],
+            prerequisites=["audio", "video_fanout" if self.use_fanout else "video"],
             work_dir=str(episode_dir)
         )
         tasks.append(merge_task)
@@ -520,9 +625,10 @@ class EncodingProject:
         mux_tasks = self._generate_mux_task(episode_num)
         tasks.extend(mux_tasks)
 
-        # 硬字幕任务
-        hardsub_tasks = self._generate_hardsub_tasks(episode_num)
-        tasks.extend(hardsub_tasks)
+        # 硬字幕任务（单次解码模式下由 video_fanout 任务一并完成）
+        if not self.use_fanout:
+            hardsub_tasks = self._generate_hardsub_tasks(episode_num)
+            tasks.extend(hardsub_tasks)
 
         # 硬字幕合并任务
         hardsub_merge_tasks = self._generate_hardsub_merge_task(episode_num)
@@ -558,6 +664,260 @@ class EncodingProject:
         # 将任务添加到项目中
         self.tasks.extend(tasks)
 
+    def _generate_fanout_task(self, episode_num):
+        """单次解码任务：滤镜链只执行一次，同时编码普通版和两种硬字幕版"""
+        episode_dir = self.root_path / f"E{episode_num.zfill(2)}"
+        fanout_vpy = episode_dir / f"{episode_num.zfill(2)}.fanout.vpy"
+
+        with open(fanout_vpy, 'w', encoding='utf-8') as f:
+            f.write(self._generate_fanout_vpy(episode_num))
+
+        fanout_task = EncodingTask(
+            episode_num,
+            "video_fanout",
+            None,  # 命令先设为None，运行时再构造
+            prerequisites=["subtitle_process"],  # 需要重命名后的字幕和子集化字体
+            work_dir=str(episode_dir)
+        )
+        fanout_task.custom_params = {
+            "input_vpy": str(fanout_vpy),
+            "outputs": [
+                (str(episode_dir / "video.mkv"), False),
+                (str(episode_dir / "chs.mkv"), True),
+                (str(episode_dir / "cht.mkv"), True)
+            ]
+        }
+        return fanout_task
+
+    def _generate_fanout_vpy(self, episode_num):
+        episode_dir = self.root_path / f"E{episode_num.zfill(2)}"
+        fonts_dir = episode_dir / "subsetted_fonts"
+
+        with open(episode_dir / f"{episode_num.zfill(2)}.vpy", 'r', encoding='utf-8') as f:
+            vpy_content = f.read()
+
+        overlays = "".join(
+            f"""core.assrender.TextSub(
+    clip=_fanout_clip,
+    file=r"{str(episode_dir / f"{episode_num.zfill(2)}.{lang}_jpn.rename.ass")}",
+    fontdir=r"{str(fonts_dir)}"
+).set_output({index})
+"""
+            for index, lang in enumerate(["chs", "cht"], 1)
+        )
+
+        return f"""{vpy_content}
+
+# 单次解码分发：输出 0 为普通版，输出 1、2 为在同一滤镜结果上渲染的硬字幕
+import vapoursynth as vs
+from vapoursynth import core
+
+_fanout_clip = vs.get_output(0)
+_fanout_clip = getattr(_fanout_clip, "clip", _fanout_clip)
+
+{overlays}"""
+
+    def generate_fanout_command(self, task):
+        commands = []
+        renames = []
+        for output_mkv, is_hardsub in task.custom_params["outputs"]:
+            params = self.get_episode_params(task.episode_num, is_hardsub)
+            x265_params = ' '.join(self.generate_x265_command(params)[1:])  # 去掉 "x265" 命令本身
+            commands.append(f'x265 --input - --y4m {x265_params} -o "{output_mkv}.part"')
+            renames.append(f'mv "{output_mkv}.part" "{output_mkv}"')
+
+        return (
+            f'"{sys.executable}" "{os.path.abspath(__file__)}" --fanout "{task.custom_params["input_vpy"]}" '
+            f'{" ".join(shlex.quote(cmd) for cmd in commands)} && '
+            f'{" && ".join(renames)}'
+        )
+
+    def _generate_chunked_video_tasks(self, episode_num, source_path):
+        """分块编码：规划任务 -> 并行的分块编码任务 -> 拼接任务"""
+        episode_dir = self.root_path / f"E{episode_num.zfill(2)}"
+        # 块数在生成任务时确定，之后修改设置不影响已生成的任务
+        chunk_count = self.video_chunks
+        # 块目录按块数命名，修改块数后不会误用旧的分块
+        chunks_dir = episode_dir / f"chunks_{chunk_count}"
+        input_vpy = episode_dir / f"{episode_num.zfill(2)}.vpy"
+        info_file = episode_dir / "video_info.txt"
+        keyframes_file = episode_dir / "source_keyframes.txt"
+        tasks = []
+
+        # 规划任务：获取帧数和源文件关键帧位置，分块边界在运行时计算
+        plan_task = EncodingTask(
+            episode_num,
+            "video_plan",
+            f'ffprobe -v error -select_streams v:0 -show_entries packet=pts,flags -of csv=p=0 '
+            f'"{str(source_path)}" > "{str(keyframes_file)}" && '
+            f'vspipe --info "{str(input_vpy)}" > "{str(info_file)}.part" && '
+            f'mv "{str(info_file)}.part" "{str(info_file)}"',
+            work_dir=str(episode_dir)
+        )
+        tasks.append(plan_task)
+
+        chunk_types = []
+        chunk_files = []
+        for index in range(chunk_count):
+            chunk_type = f"video_chunk_{index:02d}"
+            chunk_file = chunks_dir / f"chunk_{index:02d}.hevc"
+            chunk_task = EncodingTask(
+                episode_num,
+                chunk_type,
+                None,  # 命令先设为None，运行时根据分块规划构造
+                prerequisites=["video_plan"],
+                work_dir=str(episode_dir)
+            )
+            chunk_task.custom_params = {
+                "input_vpy": str(input_vpy),
+                "output_chunk": str(chunk_file),
+                "chunk_index": index,
+                "chunk_count": chunk_count,
+                "is_hardsub": False
+            }
+            tasks.append(chunk_task)
+            chunk_types.append(chunk_type)
+            chunk_files.append(chunk_file)
+
+        # 拼接任务：各块均以 IDR 帧开头，按顺序拼接码流后封装为 mkv
+        output_mkv = episode_dir / "video.mkv"
+        joined_hevc = chunks_dir / "joined.hevc"
+        concat_task = EncodingTask(
+            episode_num,
+            "video",
+            f'cat {" ".join(shlex.quote(str(f)) for f in chunk_files)} > "{str(joined_hevc)}" && '
+            f'mkvmerge -q -o "{str(output_mkv)}.part" "{str(joined_hevc)}" && '
+            f'mv "{str(output_mkv)}.part" "{str(output_mkv)}" && '
+            f'rm -rf "{str(chunks_dir)}"',
+            prerequisites=chunk_types,
+            work_dir=str(episode_dir)
+        )
+        concat_task.custom_params = {
+            "output_mkv": str(output_mkv),
+            "chunked": True
+        }
+        tasks.append(concat_task)
+
+        return tasks
+
+    def plan_video_chunks(self, episode_num, chunk_count):
+        """读取规划任务的输出，返回各块的 [start, end) 帧范围"""
+        episode_dir = self.root_path / f"E{episode_num.zfill(2)}"
+        plan_file = episode_dir / f"chunks_{chunk_count}" / "chunks.json"
+
+        # 已有的规划优先，保证续编时分块边界不变
+        if plan_file.exists():
+            with open(plan_file, 'r', encoding='utf-8') as f:
+                return [tuple(chunk) for chunk in json.load(f)]
+
+        with open(episode_dir / "video_info.txt", 'r', encoding='utf-8') as f:
+            match = re.search(r"^Frames:\s*(\d+)", f.read(), re.MULTILINE)
+        if not match:
+            raise ValueError(f"Cannot read frame count from {episode_dir / 'video_info.txt'}")
+        num_frames = int(match.group(1))
+
+        keyframes = []
+        keyframes_file = episode_dir / "source_keyframes.txt"
+        if keyframes_file.exists():
+            with open(keyframes_file, 'r', encoding='utf-8') as f:
+                packets = [line.split(",") for line in f.read().splitlines() if line]
+            # 数据包按解码顺序排列，按 pts 排序后才是显示顺序的帧号
+            try:
+                packets.sort(key=lambda packet: int(packet[0]))
+            except (ValueError, IndexError):
+                packets = []
+            # 只有脚本未改变帧数时，源文件关键帧位置才对应脚本输出的帧号
+            if len(packets) == num_frames:
+                keyframes = [i for i, packet in enumerate(packets) if packet[-1].startswith("K")]
+
+        chunks = self._split_frame_range(num_frames, chunk_count, keyframes)
+
+        os.makedirs(plan_file.parent, exist_ok=True)
+        with open(plan_file, 'w', encoding='utf-8') as f:
+            json.dump(chunks, f)
+        return chunks
+
+    def _split_frame_range(self, num_frames, chunk_count, keyframes):
+        # 均分后将边界吸附到附近的关键帧（通常是场景切换点）
+        window = num_frames // (chunk_count * 4)
+        boundaries = [0]
+        for i in range(1, chunk_count):
+            target = num_frames * i // chunk_count
+            pos = bisect_left(keyframes, target)
+            nearby = keyframes[max(pos - 1, 0):pos + 1]
+            if nearby:
+                nearest = min(nearby, key=lambda k: abs(k - target))
+                if abs(nearest - target) <= window:
+                    target = nearest
+            if target > boundaries[-1]:
+                boundaries.append(target)
+        if num_frames > boundaries[-1]:
+            boundaries.append(num_frames)
+
+        chunks = list(zip(boundaries[:-1], boundaries[1:]))
+        # 帧数少于块数时，多出的块为空
+        chunks += [(num_frames, num_frames)] * (chunk_count - len(chunks))
+        return chunks
+
+    def generate_chunk_command(self, task):
+        start, end = self.plan_video_chunks(
+            task.episode_num, task.custom_params["chunk_count"]
+        )[task.custom_params["chunk_index"]]
+        output_chunk = task.custom_params["output_chunk"]
+        chunks_dir = os.path.dirname(output_chunk)
+
+        if start >= end:
+            return f'mkdir -p "{chunks_dir}" && : > "{output_chunk}"'
+
+        params = self.get_episode_params(task.episode_num, False)
+        x265_params = ' '.join(self.generate_x265_command(params)[1:])  # 去掉 "x265" 命令本身
+        return (
+            f'mkdir -p "{chunks_dir}" && '
+            f'vspipe -c y4m -s {start} -e {end - 1} "{task.custom_params["input_vpy"]}" - | '
+            f'x265 --input - --y4m {x265_params} '
+            f'-o "{output_chunk}.part" && '
+            f'mv "{output_chunk}.part" "{output_chunk}"'
+        )
+
+    def generate_checkpointed_command(self, input_vpy, output_mkv, x265_params):
+        """
+        分段编码命令：每段为独立的闭合 GOP 码流，完成并校验帧数后记入清单。
+        任务中断后重新执行只会编码清单中缺少的分段，全部完成后按顺序拼接。
+        """
+        output_path = Path(output_mkv)
+        segments_dir = output_path.parent / f"{output_path.stem}_segments_{self.checkpoint_frames}"
+        manifest = segments_dir / "manifest.txt"
+        # 拼接结果放在分段目录之外，避免被下次续编的通配符当作分段
+        joined_hevc = output_path.parent / f"{output_path.stem}_joined.hevc"
+
+        return (
+            f'mkdir -p "{segments_dir}" && '
+            f'frames=$(vspipe --info "{input_vpy}" | sed -n "s/^Frames: *//p") && '
+            f'[ -n "$frames" ] && '
+            f'start=0 && '
+            f'while [ $start -lt $frames ]; do '
+            f'end=$((start + {self.checkpoint_frames})); '
+            f'if [ $end -gt $frames ]; then end=$frames; fi; '
+            f'seg="{segments_dir}/$(printf %08d $start).hevc"; '
+            f'if ! grep -qx "$start $end" "{manifest}" 2>/dev/null; then '
+            f'echo "Encoding segment $start-$end of $frames"; '
+            f'vspipe -c y4m -s $start -e $((end - 1)) "{input_vpy}" - | '
+            f'x265 --input - --y4m {x265_params} -o "$seg" || exit 1; '
+            f'count=$(ffprobe -v error -count_packets -select_streams v:0 '
+            f'-show_entries stream=nb_read_packets -of csv=p=0 "$seg"); '
+            f'if [ "$count" != $((end - start)) ]; then '
+            f'echo "Segment $start-$end has $count frames, expected $((end - start))"; exit 1; fi; '
+            f'echo "$start $end" >> "{manifest}"; '
+            f'fi; '
+            f'start=$end; '
+            f'done && '
+            f'rm -f "{joined_hevc}" && '
+            f'cat "{segments_dir}"/[0-9]*.hevc > "{joined_hevc}" && '
+            f'mkvmerge -q -o "{output_mkv}.part" "{joined_hevc}" && '
+            f'mv "{output_mkv}.part" "{output_mkv}" && '
+            f'rm -rf "{segments_dir}" "{joined_hevc}"'
+        )
+
     def _generate_organize_command(self, episode_num):
         episode_dir = self.root_path / f"E{episode_num.zfill(2)}"
         result_dir = self.root_path / "result"
@@ -589,7 +949,7 @@ class EncodingProject:
                 episode_num,
                 f"hardsub_{lang}",
                 None,  # 命令先设为None，运行时再构造
-                prerequisites=["merge"],
+                prerequisites=["merge", "subtitle_process"],  # 需要重命名后的字幕和子集化字体
                 work_dir=str(episode_dir)
             )
             hardsub_task.custom_params = {
@@ -637,7 +997,7 @@ sub.set_output(0)
                 f'--language 0:und "{str(episode_dir / f"{lang}.mkv")}" ' +
                 f'--language 0:ja "{str(episode_dir / f"audio{episode_num}.aac")}" ' +
                 f'--chapters "{str(list(episode_dir.glob("*.txt"))[0])}"',
-                prerequisites=[f"hardsub_{lang}"]
+                prerequisites=["video_fanout" if self.use_fanout else f"hardsub_{lang}"]
             )
             tasks.append(merge_task)
 
@@ -690,14 +1050,19 @@ class EncodingGUI:
         
         self.project = EncodingProject()
         self.running_tasks = {}
-        self.output_queues = {}
+        # 所有任务共用一个输出队列，由 GUI 线程按批次取出
+        self.output_queue = Queue.Queue()
+        self.output_flush_lock = threading.Lock()
+        self.output_flush_pending = False
+        self.scheduled_tasks = []
+        self.failed_scheduled_tasks = []
+        self.scheduler_active = False
         
         # 创建日志窗口
         self.log_window = LogWindow(self.root)
         
         # 创建GUI
         self._create_gui()
-        self._setup_task_monitor()
 
     def _create_gui(self):
         # Main container
@@ -839,6 +1204,45 @@ class EncodingGUI:
         ttk.Button(episode_btn_frame, text="应用到当前集数", command=self._apply_episode_params).pack(side=tk.LEFT, padx=5)
         ttk.Button(episode_btn_frame, text="重置当前集数", command=self._reset_episode_params).pack(side=tk.LEFT, padx=5)
 
+        # Concurrency limits
+        limits_frame = ttk.LabelFrame(control_frame, text="并发与分块")
+        limits_frame.pack(fill=tk.X, padx=5, pady=5)
+
+        self.resource_limit_vars = {}
+        resource_labels = {
+            "x265": "x265 编码",
+            "ffmpeg": "ffmpeg/flac",
+            "mkvmerge": "mkvmerge",
+            "other": "其他任务"
+        }
+
+        for resource in ["x265", "ffmpeg", "mkvmerge", "other"]:
+            frame = ttk.Frame(limits_frame)
+            frame.pack(fill=tk.X, padx=5, pady=2)
+            ttk.Label(frame, text=resource_labels[resource], width=12).pack(side=tk.LEFT)
+            var = tk.StringVar(value=str(self.project.resource_limits[resource]))
+            entry = ttk.Entry(frame, textvariable=var)
+            entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+            self.resource_limit_vars[resource] = var
+
+        frame = ttk.Frame(limits_frame)
+        frame.pack(fill=tk.X, padx=5, pady=2)
+        ttk.Label(frame, text="视频分块数", width=12).pack(side=tk.LEFT)
+        self.video_chunks_var = tk.StringVar(value=str(self.project.video_chunks))
+        ttk.Entry(frame, textvariable=self.video_chunks_var).pack(side=tk.LEFT, fill=tk.X, expand=True)
+
+        frame = ttk.Frame(limits_frame)
+        frame.pack(fill=tk.X, padx=5, pady=2)
+        ttk.Label(frame, text="断点分段帧数", width=12).pack(side=tk.LEFT)
+        self.checkpoint_frames_var = tk.StringVar(value=str(self.project.checkpoint_frames))
+        ttk.Entry(frame, textvariable=self.checkpoint_frames_var).pack(side=tk.LEFT, fill=tk.X, expand=True)
+
+        self.use_fanout_var = tk.BooleanVar(value=self.project.use_fanout)
+        ttk.Checkbutton(limits_frame, text="单次解码同时编码硬字幕",
+                        variable=self.use_fanout_var).pack(anchor=tk.W, padx=5, pady=2)
+
+        ttk.Button(limits_frame, text="应用并发设置", command=self._apply_scheduler_settings).pack(pady=5)
+
         # Task control buttons
         button_frame = ttk.LabelFrame(control_frame, text="任务控制")
         button_frame.pack(fill=tk.X, pady=5, padx=5)
@@ -881,14 +1285,6 @@ class EncodingGUI:
         y = self.root.winfo_y() + 50
         self.log_window.geometry(f"+{x}+{y}")
 
-    def _update_task_output(self, task, output):
-        try:
-            task.output.append(output)
-            log_text = f"[{task.episode_num}:{task.task_type}] {output}"
-            self.log_window.append_log(log_text)
-        except Exception as e:
-            print(f"Error updating task output: {e}")
-
     def run(self):
         # 显示日志窗口
         self.show_log_window()
@@ -1047,6 +1443,39 @@ class EncodingGUI:
                 self.project.save_encoding_params()
             messagebox.showinfo("Success", f"E{episode_num} 将使用全局编码参数")
 
+    def _apply_scheduler_settings(self):
+        for resource, var in self.resource_limit_vars.items():
+            try:
+                self.project.resource_limits[resource] = max(0, int(var.get()))
+            except ValueError:
+                messagebox.showerror("Error", f"无效的并发数: {var.get()}")
+                var.set(str(self.project.resource_limits[resource]))
+                return
+
+        # 分块数在下次生成任务时生效
+        try:
+            self.project.video_chunks = max(1, int(self.video_chunks_var.get()))
+        except ValueError:
+            messagebox.showerror("Error", f"无效的分块数: {self.video_chunks_var.get()}")
+            self.video_chunks_var.set(str(self.project.video_chunks))
+            return
+
+        try:
+            self.project.checkpoint_frames = max(0, int(self.checkpoint_frames_var.get()))
+        except ValueError:
+            messagebox.showerror("Error", f"无效的分段帧数: {self.checkpoint_frames_var.get()}")
+            self.checkpoint_frames_var.set(str(self.project.checkpoint_frames))
+            return
+
+        self.project.use_fanout = self.use_fanout_var.get()
+
+        # Save parameters to JSON
+        if self.project.params_file:
+            self.project.save_encoding_params()
+
+        # 放宽限制后可以立即启动更多任务
+        self._schedule_ready_tasks()
+
     def _reset_params(self, param_type):
         if param_type == "normal":
             self.project.current_normal_x265_params = self.project.default_normal_x265_params.copy()
@@ -1072,7 +1501,7 @@ class EncodingGUI:
         self._update_episode_params_display()
 
     def _update_running_tasks_params(self):
-        for task_id, (task, queue) in self.running_tasks.items():
+        for task_id, task in self.running_tasks.items():
             if task.status == "pending":
                 if "hardsub" in task.task_type:
                     params = self.project.current_hardsub_x265_params
@@ -1091,26 +1520,6 @@ class EncodingGUI:
                         f"-o {lang}.mkv"
                     ]
 
-    def _setup_task_monitor(self):
-        self.monitor_thread = threading.Thread(target=self._monitor_tasks, daemon=True)
-        self.monitor_thread.start()
-
-    def _monitor_tasks(self):
-        while True:
-            for task_id, (task, output_queue) in list(self.running_tasks.items()):
-                try:
-                    while True:
-                        output = output_queue.get_nowait()
-                        self._update_task_output(task, output)
-                except QueueEmpty:
-                    pass
-
-                if task.process and task.process.poll() is not None:
-                    self._task_completed(task)
-                    del self.running_tasks[task_id]
-
-                time.sleep(0.1)
-    
     def _update_gui_after_load(self):
         """更新 GUI 以反映加载的参数"""
         # 更新普通编码参数显示
@@ -1120,6 +1529,13 @@ class EncodingGUI:
         # 更新硬字幕编码参数显示
         for param, var in self.hardsub_param_vars.items():
             var.set(str(self.project.current_hardsub_x265_params[param]))
+
+        # 更新并发限制显示
+        for resource, var in self.resource_limit_vars.items():
+            var.set(str(self.project.resource_limits.get(resource, 0)))
+        self.video_chunks_var.set(str(self.project.video_chunks))
+        self.checkpoint_frames_var.set(str(self.project.checkpoint_frames))
+        self.use_fanout_var.set(self.project.use_fanout)
                 
     def _setup_project(self, root_path):
         self.project.setup_project(root_path)
@@ -1223,29 +1639,8 @@ class EncodingGUI:
         for item in self.tree.get_children():
             self.tree.delete(item)
 
-        # 定义任务类型的顺序
-        task_type_order = {
-            "subtitle_process": 1,
-            "subtitle_cleanup": 2,
-            "audio": 3,
-            "video": 4,
-            "merge": 5,
-            "mux": 6,
-            "hardsub_chs": 7,
-            "hardsub_cht": 8,
-            "hardsub_chs_merge": 9,
-            "hardsub_cht_merge": 10,
-            "organize": 11
-        }
-
-        # 对任务进行排序
-        sorted_tasks = sorted(
-            self.project.tasks,
-            key=lambda x: (
-                int(x.episode_num),  # 首先按集数排序
-                task_type_order.get(x.task_type, 999)  # 然后按任务类型排序
-            )
-        )
+        # 对任务进行排序：首先按集数，然后按任务类型
+        sorted_tasks = sorted(self.project.tasks, key=task_sort_key)
 
         # 重新插入所有任务并记录新的item ID
         new_items = {}
@@ -1317,63 +1712,66 @@ class EncodingGUI:
                 self._pause_task(task)
     
     def _start_all(self):
-        """Start all tasks in sequence"""
-        # Sort tasks by episode number and predefined order
-        task_type_order = {
-            "subtitle_process": 1,
-            "subtitle_cleanup": 2,
-            "audio": 3,
-            "video": 4,
-            "merge": 5,
-            "mux": 6,
-            "hardsub_chs": 7,
-            "hardsub_cht": 8,
-            "hardsub_chs_merge": 9,
-            "hardsub_cht_merge": 10,
-            "organize": 11
-        }
-        
-        sorted_tasks = sorted(
-            self.project.tasks,
-            key=lambda x: (int(x.episode_num), task_type_order.get(x.task_type, 999))
+        """Start all tasks, running every task whose prerequisites are met concurrently"""
+        self.scheduled_tasks = [
+            task for task in self.project.tasks
+            if task.status not in ["completed", "running"]
+        ]
+        self.failed_scheduled_tasks = []
+        self.scheduler_active = True
+        self._schedule_ready_tasks()
+
+    def _schedule_ready_tasks(self):
+        """Start every scheduled task that is ready and has a free resource slot"""
+        if not self.scheduler_active:
+            return
+
+        running = Counter(
+            task.resource_class for task in self.project.tasks
+            if task.status == "running"
         )
-        
-        def execute_next_task(tasks):
-            if not tasks:
-                return
-                
-            task = tasks[0]
-            if task.status not in ["completed", "running"]:
-                if self._check_prerequisites(task):
-                    self._start_task(task)
-                    # Schedule check for next task
-                    self.root.after(1000, lambda: self._check_task_completion(task, tasks[1:]))
-                else:
-                    # Skip this task and move to next
-                    execute_next_task(tasks[1:])
+
+        for task in sorted(self.scheduled_tasks, key=task_sort_key):
+            if task.status in ["completed", "running"]:
+                self.scheduled_tasks.remove(task)
+                continue
+            if not self._check_prerequisites(task):
+                continue
+
+            resource = task.resource_class
+            limit = self.project.resource_limits.get(resource, 0)
+            if limit > 0 and running[resource] >= limit:
+                continue
+
+            self.scheduled_tasks.remove(task)
+            self._start_task(task)
+            if task.status == "running":
+                running[resource] += 1
             else:
-                # Skip this task and move to next
-                execute_next_task(tasks[1:])
-        
-        execute_next_task(sorted_tasks)
-
-    def _check_task_completion(self, current_task, remaining_tasks):
-        """Check if current task is completed and start next task if it is"""
-        if current_task.status == "completed":
-            self._start_all_execute_next(remaining_tasks)
-        elif current_task.status == "failed":
-            messagebox.showerror("Error", f"Task failed: {current_task.episode_num}:{current_task.task_type}")
-        elif current_task.status == "running":
-            # Check again after 1 second
-            self.root.after(1000, lambda: self._check_task_completion(current_task, remaining_tasks))
-
-    def _start_all_execute_next(self, remaining_tasks):
-        """Execute next task in the sequence"""
-        if remaining_tasks:
-            self._start_all()
+                self.failed_scheduled_tasks.append(task)
+
+        # 没有正在运行的任务时，剩余任务已无法再满足前置条件
+        if not any(task.status == "running" for task in self.project.tasks):
+            self._finish_scheduling()
+
+    def _finish_scheduling(self):
+        blocked = self.scheduled_tasks
+        failed = self.failed_scheduled_tasks
+        self.scheduler_active = False
+        self.scheduled_tasks = []
+        self.failed_scheduled_tasks = []
+
+        if failed:
+            messagebox.showerror("Error", "Task failed: " + ", ".join(
+                f"{task.episode_num}:{task.task_type}" for task in failed))
+        if blocked:
+            self.log_window.append_log("Tasks not started because prerequisites failed: " + ", ".join(
+                f"{task.episode_num}:{task.task_type}" for task in blocked) + "\n")
 
     def _stop_all(self):
         """Stop all running tasks"""
+        self.scheduler_active = False
+        self.scheduled_tasks = []
         for task in self.project.tasks:
             if task.status == "running":
                 self._stop_task(task)
@@ -1396,12 +1794,30 @@ class EncodingGUI:
             return
 
         # 如果是编码任务，在运行时构造命令
-        if task.task_type == "video" or (("hardsub_" in task.task_type) and ("merge" not in task.task_type)):
+        if task.task_type.startswith("video_chunk_"):
+            try:
+                task.command = self.project.generate_chunk_command(task)
+            except Exception as e:
+                task.status = "failed"
+                self.log_window.append_log(f"分块规划失败: {str(e)}\n")
+                return
+        elif task.custom_params.get("chunked"):
+            pass  # 拼接命令在生成任务时已确定
+        elif task.task_type == "video_fanout":
+            task.command = self.project.generate_fanout_command(task)
+        elif task.task_type == "video" or (("hardsub_" in task.task_type) and ("merge" not in task.task_type)):
             is_hardsub = task.custom_params.get("is_hardsub")
             params = self.project.get_episode_params(task.episode_num, is_hardsub)
             
             x265_command = self.project.generate_x265_command(params)
-            if isinstance(x265_command, list):
+            if isinstance(x265_command, list) and self.project.checkpoint_frames > 0:
+                x265_params = ' '.join(x265_command[1:])  # 去掉 "x265" 命令本身
+                task.command = self.project.generate_checkpointed_command(
+                    task.custom_params["input_vpy"],
+                    task.custom_params["output_mkv"],
+                    x265_params
+                )
+            elif isinstance(x265_command, list):
                 x265_params = ' '.join(x265_command[1:])  # 去掉 "x265" 命令本身
                 task.command = (
                     f'vspipe -c y4m "{task.custom_params["input_vpy"]}" - | '
@@ -1415,9 +1831,6 @@ class EncodingGUI:
         task.start_time = datetime.now()
         task.output = []
 
-        output_queue = Queue.Queue()
-        self.output_queues[task] = output_queue
-
         if task.command is None:
             task.status = "failed"
             self.log_window.append_log(f"任务命令未正确设置: {task.task_type}\n")
@@ -1439,10 +1852,11 @@ class EncodingGUI:
             task.status = "running"
             task.start_time = datetime.now()
             
-            self.running_tasks[id(task)] = (task, output_queue)
+            self.running_tasks[id(task)] = task
+            # 每个进程一个读取线程，读到 EOF 后等待进程退出并通知 GUI 线程
             threading.Thread(
                 target=self._read_output,
-                args=(task, process, output_queue),
+                args=(task, process),
                 daemon=True
             ).start()
 
@@ -1450,7 +1864,7 @@ class EncodingGUI:
             
         except Exception as e:
             task.status = "failed"
-            self.log_window.append_log.insert(f"启动任务失败: {str(e)}\n")
+            self.log_window.append_log(f"启动任务失败: {str(e)}\n")
 
     def _check_prerequisites(self, task):
         if not task.prerequisites:
@@ -1462,7 +1876,7 @@ class EncodingGUI:
                 return False
         return True
 
-    def _read_output(self, task, process, queue):
+    def _read_output(self, task, process):
         try:
             while True:
                 line = process.stdout.readline()
@@ -1470,27 +1884,62 @@ class EncodingGUI:
                     break
                 if task.status == "stopped":
                     break
-                queue.put(line)
+                self._post_output(task, line)
         except (IOError, ValueError) as e:
             # 进程被终止时可能会抛出这些异常
             if task.status != "stopped":
                 print(f"Error reading output: {e}")
         finally:
-            # 确保进程被终止
             try:
-                if process.poll() is None:  # 如果进程还在运行
-                    os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+                if task.status == "stopped":
+                    # 确保被停止的进程被终止
+                    if process.poll() is None:
+                        os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+                else:
+                    process.wait()
             except Exception as e:
                 print(f"Error in final process cleanup: {e}")
+            self.root.after(0, self._task_completed, task, process)
+
+    def _post_output(self, task, line):
+        """Queue one output line and schedule a batched flush on the GUI thread"""
+        self.output_queue.put((task, line))
+        with self.output_flush_lock:
+            if self.output_flush_pending:
+                return
+            self.output_flush_pending = True
+        self.root.after(100, self._flush_output)
 
-    def _update_task_output(self, task, output):
-        task.output.append(output)
-        self.log_window.append_log( f"[{task.episode_num}:{task.task_type}] {output}")
+    def _flush_output(self):
+        with self.output_flush_lock:
+            self.output_flush_pending = False
 
-    def _task_completed(self, task):
+        lines = []
+        try:
+            while True:
+                task, output = self.output_queue.get_nowait()
+                task.output.append(output)
+                lines.append(f"[{task.episode_num}:{task.task_type}] {output}")
+        except QueueEmpty:
+            pass
+
+        if lines:
+            self.log_window.append_log("".join(lines))
+
+    def _task_completed(self, task, process):
+        # 任务已被停止或重新启动时忽略旧进程的退出
+        if task.process is not process or task.status != "running":
+            return
+
+        self._flush_output()
+        self.running_tasks.pop(id(task), None)
         task.end_time = datetime.now()
-        task.status = "completed" if task.process.returncode == 0 else "failed"
+        task.status = "completed" if process.returncode == 0 else "failed"
+        if task.status == "failed" and self.scheduler_active:
+            self.failed_scheduled_tasks.append(task)
         self._refresh_task_tree()
+        # 任务结束后立即调度后续任务
+        self._schedule_ready_tasks()
 
     def _stop_task(self, task):
         if task.process:
@@ -1520,6 +1969,8 @@ class EncodingGUI:
                     del self.running_tasks[task_id]
                 
                 self._refresh_task_tree()
+                # 释放的资源槽位可以给其他任务使用
+                self._schedule_ready_tasks()
                 
                 # 添加停止信息到输出
                 self.log_window.append_log(f"[{task.episode_num}:{task.task_type}] Task stopped by user\n")
@@ -1549,7 +2000,107 @@ class EncodingGUI:
             except Exception as e:
                 print(f"Error pausing/resuming task: {e}")
 
+def _y4m_header(clip):
+    import vapoursynth as vs
+
+    fmt = clip.format
+    bits = fmt.bits_per_sample
+    if fmt.color_family == vs.GRAY:
+        colorspace = "mono" if bits == 8 else f"mono{bits}"
+    else:
+        colorspace = {
+            (1, 1): "420",
+            (1, 0): "422",
+            (0, 0): "444",
+            (2, 0): "411"
+        }[(fmt.subsampling_w, fmt.subsampling_h)]
+        if bits > 8:
+            colorspace += f"p{bits}"
+        elif colorspace == "420":
+            colorspace = "420jpeg"
+
+    return (
+        f"YUV4MPEG2 W{clip.width} H{clip.height} F{clip.fps.numerator}:{clip.fps.denominator} "
+        f"Ip A0:0 C{colorspace} XLENGTH={clip.num_frames}\n"
+    ).encode()
+
+def _fanout_writer(process, frames):
+    """把帧队列写入一个编码器，慢的编码器只会阻塞自己的队列"""
+    try:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break
+            if isinstance(frame, bytes):
+                process.stdin.write(frame)
+                continue
+            process.stdin.write(b"FRAME\n")
+            for plane in range(frame.format.num_planes):
+                process.stdin.write(memoryview(frame[plane]).tobytes())
+    except (BrokenPipeError, OSError) as e:
+        print(f"Encoder stopped accepting input: {e}", flush=True)
+        # 继续取出剩余的帧，避免阻塞分发线程
+        while frames.get() is not None:
+            pass
+    finally:
+        try:
+            process.stdin.close()
+        except Exception:
+            pass
+
+def fanout_encode(vpy_path, commands):
+    """
+    单次解码分发：脚本只加载一次，第 i 个输出节点以 y4m 格式送入第 i 个编码命令。
+    各输出共享同一个 core，上游滤镜的帧缓存使公共部分只计算一次。
+    """
+    import runpy
+    import vapoursynth as vs
+
+    runpy.run_path(vpy_path, run_name="__vapoursynth__")
+    outputs = vs.get_outputs()
+    nodes = [getattr(outputs[index], "clip", outputs[index]) for index in range(len(commands))]
+
+    num_frames = nodes[0].num_frames
+    if any(node.num_frames != num_frames for node in nodes):
+        print("All outputs must have the same number of frames", flush=True)
+        return 1
+
+    processes = []
+    writers = []
+    for node, command in zip(nodes, commands):
+        print(f"Starting encoder: {command}", flush=True)
+        process = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE)
+        frames = Queue.Queue(maxsize=8)
+        frames.put(_y4m_header(node))
+        writer = threading.Thread(target=_fanout_writer, args=(process, frames), daemon=True)
+        writer.start()
+        processes.append(process)
+        writers.append((writer, frames))
+
+    # 同时请求多帧以保持滤镜链并行，按帧号顺序分发给所有编码器
+    prefetch = max(vs.core.num_threads, 1)
+    pending = []
+    try:
+        for n in range(num_frames + prefetch):
+            if n < num_frames:
+                pending.append([node.get_frame_async(n) for node in nodes])
+            if len(pending) > prefetch or (n >= num_frames and pending):
+                for future, (writer, frames) in zip(pending.pop(0), writers):
+                    frames.put(future.result())
+    finally:
+        for writer, frames in writers:
+            frames.put(None)
+        for writer, frames in writers:
+            writer.join()
+
+    # 返回第一个失败的退出码；被信号终止的编码器按 shell 习惯记为 128+信号
+    return_codes = [process.wait() for process in processes]
+    return next((128 - code if code < 0 else code for code in return_codes if code), 0)
+
 def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--fanout":
+        sys.exit(fanout_encode(sys.argv[2], sys.argv[3:]))
+
     gui = EncodingGUI()
     gui.run()
 
@@ -1,7 +1,125 @@
 # Original by Kukoc@Magic-Raws https://skyeysnow.com/forum.php?mod=viewthread&tid=41638
 import argparse
+import mmap
 import os
+import re
+import shlex
+import shutil
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+KFIDX_HEADER = struct.Struct('<4sQQII')  # magic, file size, mtime_ns, num_frames, keyframe count
+KFIDX_MAGIC = b'KFI1'
+
+# x264/x265 progress, e.g. "[12.3%] 123/1000 frames, 45.67 fps, ..." or "123 frames: 45.67 fps, ..."
+PROGRESS_RE = re.compile(rb'(\d+)(?:/\d+)? frames[:,] ([\d.]+) fps')
+PROGRESS_INTERVAL = 5.0
+MKVTOOLNIX_OK = (0, 1)  # mkvmerge/mkvextract exit with 1 on warnings
+
+
+class PipelineError(RuntimeError):
+    pass
+
+
+def run_pipeline(name: str, stages: list, ok_codes=(0,), total_frames: int = None):
+    """
+    Run argv lists as one pipeline, each stage's stdout feeding the next stage's stdin.
+    Raise PipelineError if any stage exits with a code outside ok_codes. With total_frames,
+    the last stage's stderr is parsed as x264/x265 progress and fps/ETA are printed.
+    """
+    procs = []
+    readers = []
+    tails = []
+    starts = []
+    start = time.time()
+    try:
+        for i, argv in enumerate(stages):
+            last = i == len(stages) - 1
+            proc = subprocess.Popen(
+                argv,
+                stdin=procs[-1].stdout if procs else subprocess.DEVNULL,
+                stdout=None if last else subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            if procs:
+                procs[-1].stdout.close()  # the next stage owns it now, so a dying consumer gives SIGPIPE upstream
+            procs.append(proc)
+            starts.append(time.time())
+            tail = deque(maxlen=20)
+            tails.append(tail)
+            reader = threading.Thread(
+                target=_read_stderr,
+                args=(proc.stderr, tail, name, total_frames if last else None, start),
+                daemon=True
+            )
+            reader.start()
+            readers.append(reader)
+    except OSError as e:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise PipelineError(f"{name}: cannot start {stages[len(procs)][0]}: {e}")
+
+    times = [_wait_stage(proc, started) for proc, started in zip(procs, starts)]
+    for reader in readers:
+        reader.join()
+
+    print(f"[{name}] " + ", ".join(
+        f"{argv[0]} wall {wall:.1f}s" + (f" cpu {cpu:.1f}s" if cpu is not None else "")
+        for argv, (wall, cpu) in zip(stages, times)
+    ))
+    failed = [
+        f"{argv[0]} exited with {proc.returncode}\n" + "\n".join(tail)
+        for argv, proc, tail in zip(stages, procs, tails) if proc.returncode not in ok_codes
+    ]
+    if failed:
+        raise PipelineError(f"{name}: " + "\n".join(failed))
+
+
+def _wait_stage(proc, start):
+    """Wait for one stage, return (wall seconds since start, cpu seconds or None)."""
+    if hasattr(os, 'wait4'):
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        return time.time() - start, rusage.ru_utime + rusage.ru_stime
+    proc.wait()
+    return time.time() - start, None
+
+
+def _read_stderr(stream, tail, name, total_frames, start):
+    last_report = 0.0
+    pending = b''
+    while True:
+        data = stream.read1(65536) if hasattr(stream, 'read1') else stream.read(65536)
+        if not data:
+            break
+        pending += data
+        lines = re.split(rb'[\r\n]', pending)
+        pending = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            tail.append(line.decode('utf-8', errors='ignore').strip())
+            if total_frames:
+                progress = PROGRESS_RE.search(line)
+                now = time.time()
+                if progress and now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    done, fps = int(progress.group(1)), float(progress.group(2))
+                    eta = (total_frames - done) / fps if fps > 0 else 0
+                    print(f"[{name}] {done}/{total_frames} frames, {fps:.2f} fps, "
+                          f"ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}, elapsed {now - start:.0f}s")
+    if pending.strip():
+        tail.append(pending.decode('utf-8', errors='ignore').strip())
+    stream.close()
 
 def SEM(
     fp_vc_input: str,
@@ -11,17 +129,23 @@ def SEM(
     fp_vc_output: str,
     fp_qpfile: str = None,
     encoder: str = "x265",
-    force_expand: bool = True
+    force_expand: bool = True,
+    jobs: int = 1,
+    fp_tmpdir: str = None,
+    retries: int = 1,
+    splice: bool = False,
+    verify: bool = False
 ):
     """
     Split, Encode then Merge for closed GOP hevc or avc file.
     """
-    from vapoursynth import core
-
     valid_exts = ['.hevc', '.avc', '.265', '.264']
     ext = os.path.splitext(fp_vc_input)[1]
     if ext not in valid_exts:
         raise ValueError(f'Input file invalid.')
+    codec = 'hevc' if ext in ('.hevc', '.265') else 'avc'
+    if splice and codec != ('hevc' if encoder == 'x265' else 'avc'):
+        raise ValueError(f'Cannot splice {encoder} segments into a {codec} stream.')
 
     print(f"Input file: {fp_vc_input}")
     print(f"Segment list: {segment_list}")
@@ -31,6 +155,11 @@ def SEM(
     print(f"Output file: {fp_vc_output}")
     print(f"QPFile: {fp_qpfile if fp_qpfile else 'None'}")
     print(f"Force expand: {force_expand}")
+    print(f"Jobs: {jobs}")
+    print(f"Retries: {retries}")
+    print(f"Splice: {splice}")
+    print(f"Verify: {verify}")
+    print(f"Temp dir: {fp_tmpdir if fp_tmpdir else 'system default'}")
 
     if os.name == 'nt':  # Windows
         path_var = 'Path'
@@ -44,130 +173,525 @@ def SEM(
     else:
         os.environ[path_var] = sys.prefix + path_separator + "x26x" + ":" + sys.prefix
 
+    num_frames, _ = load_keyframe_index(fp_vc_input)
+
     if force_expand:
         iframe_segment_list = expand_segment_to_iframe(fp_vc_input, segment_list)
     else:
         iframe_segment_list = segment_list
 
     iframe_segment_list = sort_segment(iframe_segment_list)
-
-    qp = None
-    if fp_qpfile:
-        with open(fp_qpfile, "r") as f:
-            qpstr = f.readlines()
-        qpstr = [i for i in qpstr if i != "\n"]
-        qpstr = [i if i.endswith("\n") else i + "\n" for i in qpstr]
-        qpstr = [i[:-3] for i in qpstr]
-        qp = [int(i) for i in qpstr]
-
-    file = '_tomerge.mkv'
-
-    print(f"Running mkvmerge: mkvmerge -o \"{file}\" \"{fp_vc_input}\"")
-    os.system(f'mkvmerge -o "{file}" "{fp_vc_input}"')
-
-    qp_idx = 0
-    last_Iframe = 0
-    for seg in iframe_segment_list:
-        Iframe1, Iframe2 = seg[0], seg[1]
-        tmp_qp = []
-        if qp:
-            while qp_idx < len(qp):
-                Qx = qp[qp_idx]
-                if Qx < Iframe1:
-                    qp_idx += 1
-                elif Iframe1 <= Qx < Iframe2:
-                    tmp_qp += [Qx - Iframe1]
-                    qp_idx += 1
-                else:
-                    break
-            tmp_qp_str = "\n".join([f"{i} K" for i in tmp_qp])
-            with open("tmp_qp.qpfile", "w") as f:
-                f.write(tmp_qp_str)
-
-        # set file ext base on encoder type
-        ext = ".265" if encoder == "x265" else ".264"
-
-        encoder_command = f'{encoder} {x26x_param}'
-        print(f"Using encoder command: {encoder_command}")
-        print(f"Processing segment: {Iframe1}-{Iframe2}")
-
-        if Iframe1 == 0:
+    plan = plan_segments(iframe_segment_list, num_frames)
+    copy_ranges = [(l, r) for kind, l, r in plan if kind == 'copy']
+    print(f"Plan: {len(plan) - len(copy_ranges)} re-encoded, {len(copy_ranges)} copied ranges")
+
+    qp = load_qpfile(fp_qpfile) if fp_qpfile else None
+
+    # set file ext base on encoder type
+    ext = ".265" if encoder == "x265" else ".264"
+    encoder_command = [encoder] + shlex.split(x26x_param)
+    print(f"Using encoder command: {shlex.join(encoder_command)}")
+
+    # untouched ranges are as big as the output, keep them on the output disk;
+    # re-encoded segments and qpfiles are small and go to --tmpdir
+    work_dir = tempfile.mkdtemp(prefix="part_reencode_", dir=os.path.dirname(os.path.abspath(fp_vc_output)))
+    tmp_dir = None
+    try:
+        tmp_dir = tempfile.mkdtemp(prefix="part_reencode_", dir=fp_tmpdir)
+        print(f"Workspace: {work_dir}, temp: {tmp_dir}")
+
+        # all untouched ranges in one split, mkvmerge writes them as _copy-001.mkv, _copy-002.mkv, ...
+        if copy_ranges and not splice:
+            parts = ",".join(f"{l + 1}-{r + 1 if r < num_frames else ''}" for l, r in copy_ranges)
+            command = ['mkvmerge', '-o', os.path.join(work_dir, "_copy-%03d.mkv"), '--split', f'parts-frames:{parts}', fp_vc_input]
+            print(f"Running mkvmerge for untouched ranges: {shlex.join(command)}")
+            run_pipeline("split", [command], MKVTOOLNIX_OK)
+
+        pieces = []
+        segments = []
+        copy_idx = 0
+        for kind, Iframe1, Iframe2 in plan:
+            if kind == 'copy':
+                copy_idx += 1
+                pieces.append(os.path.join(work_dir, f"_copy-{copy_idx:03d}.mkv"))
+                continue
+
+            seg_name = os.path.join(tmp_dir, f"_seg{len(pieces):04d}")
+            fp_seg_qpfile = None
             if qp:
-                command = f'VSPipe "{fp_vpy}" -c y4m -s {Iframe1} -e {Iframe2 - 1} - | {encoder_command} --qpfile "tmp_qp.qpfile" -o "_newseg{ext}" -'
-            else:
-                command = f'VSPipe "{fp_vpy}" -c y4m -s {Iframe1} -e {Iframe2 - 1} - | {encoder_command} -o "_newseg{ext}" -'
+                fp_seg_qpfile = seg_name + ".qpfile"
+                with open(fp_seg_qpfile, "w") as f:
+                    f.write(slice_qpfile(qp, Iframe1, Iframe2))
 
-            print(f"Running command: {command}")
-            os.system(command)
+            piece = None if splice else seg_name + ".mkv"
+            segments.append((Iframe1, Iframe2, seg_name + ext, piece, fp_seg_qpfile))
+            pieces.append(piece)
 
-            print(f"Running mkvmerge for first segment: mkvmerge -o \"_lastseg.mkv\" \"_newseg{ext}\"")
-            os.system(f'mkvmerge -o "_lastseg.mkv" "_newseg{ext}"')
-        else:
-            if os.path.exists("_lastseg.mkv"):
-                print(f"Running mkvmerge for segment: mkvmerge -o \"_newseg.mkv\" --split parts-frames:{last_Iframe+1}-{Iframe1+1} \"{file}\"")
-                os.system(f'mkvmerge -o "_newseg.mkv" --split parts-frames:{last_Iframe+1}-{Iframe1+1} "{file}"')
-                print(f"Merging last segment: mkvmerge -o \"_last.mkv\" \"_lastseg.mkv\" + \"_newseg.mkv\"")
-                os.system(f'mkvmerge -o "_last.mkv" "_lastseg.mkv" + "_newseg.mkv"')
-            else:
-                print(f"Running mkvmerge for split: mkvmerge -o \"_last.mkv\" --split parts-frames:{last_Iframe+1}-{Iframe1+1} \"{file}\"")
-                os.system(f'mkvmerge -o "_last.mkv" --split parts-frames:{last_Iframe+1}-{Iframe1+1} "{file}"')
+        # segments are independent once aligned to keyframes, the threads only wait on vspipe/encoder processes
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            list(pool.map(lambda seg: encode_segment(fp_vpy, encoder_command, *seg, retries=retries), segments))
 
-            if qp:
-                command = f'VSPipe "{fp_vpy}" -c y4m -s {Iframe1} -e {Iframe2 - 1} - | {encoder_command} --qpfile "tmp_qp.qpfile" -o "_newseg{ext}" -'
-            else:
-                command = f'VSPipe "{fp_vpy}" -c y4m -s {Iframe1} -e {Iframe2 - 1} - | {encoder_command} -o "_newseg{ext}" -'
+        if splice:
+            print(f"Splicing {len(plan)} ranges into {fp_vc_output}")
+            splice_annexb(fp_vc_input, codec, plan, {(seg[0], seg[1]): seg[2] for seg in segments}, fp_vc_output)
+        else:
+            joined = os.path.join(work_dir, "_joined.mkv")
+            command = ['mkvmerge', '-o', joined, pieces[0]]
+            for piece in pieces[1:]:
+                command += ['+', piece]
+            print(f"Joining {len(pieces)} pieces: {shlex.join(command)}")
+            run_pipeline("join", [command], MKVTOOLNIX_OK)
+
+            print(f"Extracting final output: mkvextract \"{joined}\" tracks 0:\"{fp_vc_output}\"")
+            run_pipeline("extract", [['mkvextract', joined, 'tracks', f'0:{fp_vc_output}']], MKVTOOLNIX_OK)
+
+        if verify:
+            verify_output(fp_vc_input, fp_vc_output, fp_vpy, plan, tmp_dir)
+    finally:
+        print(f"Cleaning up temporary files...")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print("Cleanup completed.")
+
+def verify_output(fp_vc_input: str, fp_vc_output: str, fp_vpy: str, plan: list, cache_dir: str,
+                  window: int = 2, max_diff: float = 0.02):
+    """
+    Check the frames around every re-encoded range. Copied frames must be identical to the input.
+    Re-encoded frames are compared with the vpy on downscaled luma. Each boundary window is scored at
+    offsets -1, 0 and +1; the segment is misaligned only if another offset is clearly better in total
+    and offset 0 is off by more than max_diff. Raises ValueError on the first bad frame.
+    """
+    import vapoursynth as vs
+    from vapoursynth import core
 
-            print(f"Running command: {command}")
-            os.system(command)
+    src = core.lsmas.LWLibavSource(fp_vc_input, cachefile=os.path.join(cache_dir, "input.lwi"))
+    out = core.lsmas.LWLibavSource(fp_vc_output, cachefile=os.path.join(cache_dir, "output.lwi"))
+    vs.clear_outputs()
+    with open(fp_vpy, 'rb') as f:
+        exec(compile(f.read(), fp_vpy, 'exec'), {'__file__': fp_vpy, '__name__': '__vapoursynth__'})
+    ref = vs.get_output(0)
+    ref = getattr(ref, 'clip', ref)
+
+    if out.num_frames != src.num_frames:
+        raise ValueError(f'Output has {out.num_frames} frames, input has {src.num_frames}')
+
+    def small_luma(clip):
+        return core.resize.Bilinear(clip, max(16, clip.width // 4 // 2 * 2), max(16, clip.height // 4 // 2 * 2), format=vs.GRAYS)
+
+    out_small, ref_small = small_luma(out), small_luma(ref)
+
+    def diff(a, b, plane=0):
+        return core.std.PlaneStats(a, b, plane=plane).get_frame(0).props['PlaneStatsDiff']
+
+    encoded = [(l, r) for kind, l, r in plan if kind == 'encode']
+    frames = set()
+    for l, r in encoded:
+        for boundary in (l, r):
+            frames.update(range(max(0, boundary - window), min(out.num_frames, boundary + window)))
+
+    for l, r in encoded:
+        for boundary in (l, r):
+            window_frames = range(max(l, boundary - window), min(r, boundary + window))
+            if not window_frames:
+                continue
+            # Grain on near-static shots makes single-frame comparisons noisy, so score the whole window
+            diffs = {d: [diff(out_small[n], ref_small[n + d]) for n in window_frames]
+                     for d in (-1, 0, 1) if 0 <= window_frames[0] + d and window_frames[-1] + d < ref.num_frames}
+            totals = {d: sum(v) for d, v in diffs.items()}
+            best = min(totals, key=totals.get)
+            print(f"Verify frames {window_frames[0]}-{window_frames[-1]} (re-encoded): "
+                  f"mean diff {totals[0] / len(window_frames):.5f}, best offset {best:+d}")
+            if best != 0 and totals[best] < 0.5 * totals[0] and totals[0] / len(window_frames) > max_diff:
+                raise ValueError(f'Frames {window_frames[0]}-{window_frames[-1]} match vpy offset {best:+d} better, '
+                                 f'segment {l}-{r} is misaligned')
+            for n, d in zip(window_frames, diffs[0]):
+                if d > max_diff:
+                    raise ValueError(f'Frame {n} differs from vpy frame {n} by {d:.5f}')
+
+    for n in sorted(frames):
+        i = bisect_right(encoded, (n, float('inf'))) - 1
+        if i < 0 or not encoded[i][0] <= n < encoded[i][1]:
+            for plane in range(out.format.num_planes):
+                d = diff(out[n], src[n], plane)
+                if d != 0:
+                    raise ValueError(f'Frame {n} (copied) plane {plane} differs from input by {d:.5f}')
+            print(f"Verify frame {n} (copied): identical")
+    print(f"Verified {len(frames)} frames around {len(encoded)} re-encoded ranges.")
+
+
+def encode_segment(fp_vpy: str, encoder_command: list, Iframe1: int, Iframe2: int, seg_file: str, piece: str,
+                   fp_qpfile: str = None, retries: int = 1):
+    name = f"{Iframe1}-{Iframe2}"
+    vspipe = ['VSPipe', fp_vpy, '-c', 'y4m', '-s', str(Iframe1), '-e', str(Iframe2 - 1), '-']
+    encode = list(encoder_command)
+    if fp_qpfile:
+        encode += ['--qpfile', fp_qpfile]
+    encode += ['-o', seg_file, '-']
+
+    for attempt in range(retries + 1):
+        print(f"Processing segment: {name}" + (f" (retry {attempt})" if attempt else ""))
+        print(f"Running command: {shlex.join(vspipe)} | {shlex.join(encode)}")
+        try:
+            run_pipeline(name, [vspipe, encode], total_frames=Iframe2 - Iframe1)
+            if piece is None:
+                return
+            print(f"Running mkvmerge for new segment: mkvmerge -o \"{piece}\" \"{seg_file}\"")
+            run_pipeline(name, [['mkvmerge', '-o', piece, seg_file]], MKVTOOLNIX_OK)
+            return
+        except PipelineError as e:
+            print(f"Segment {name} failed: {e}")
+            for f in (seg_file, piece):
+                if f and os.path.exists(f):
+                    os.remove(f)
+            if attempt == retries:
+                raise
+
+
+def load_qpfile(fp_qpfile: str):
+    """
+    Parse a qpfile into (frames, entries): a sorted array of frame numbers and the matching
+    (type, qp) pairs, qp being None when the line has no QP column.
+    """
+    parsed = []
+    with open(fp_qpfile, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            try:
+                frame = int(fields[0])
+                frame_type = fields[1] if len(fields) > 1 else 'K'
+                qp = int(fields[2]) if len(fields) > 2 else None
+            except ValueError:
+                raise ValueError(f'Invalid qpfile line {line_no}: {line.strip()}')
+            parsed.append((frame, frame_type, qp))
+    parsed.sort(key=lambda x: x[0])
+    return array('I', [i[0] for i in parsed]), [i[1:] for i in parsed]
+
+
+def slice_qpfile(qp, Iframe1: int, Iframe2: int):
+    """Return the qpfile text for frames [Iframe1, Iframe2), renumbered from 0."""
+    frames, entries = qp
+    lo, hi = bisect_left(frames, Iframe1), bisect_left(frames, Iframe2)
+    lines = []
+    for frame, (frame_type, qp_value) in zip(frames[lo:hi], entries[lo:hi]):
+        lines.append(f"{frame - Iframe1} {frame_type}" if qp_value is None else f"{frame - Iframe1} {frame_type} {qp_value}")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def plan_segments(segment_list: list, num_frames: int):
+    """
+    Cover [0, num_frames) with ('copy', l, r) and ('encode', l, r) ranges in frame order.
+    segment_list must be sorted and non-overlapping, as returned by sort_segment.
+    """
+    plan = []
+    last = 0
+    for l, r in segment_list:
+        r = min(r, num_frames)
+        if l >= r:
+            continue
+        if last < l:
+            plan.append(('copy', last, l))
+        plan.append(('encode', l, r))
+        last = r
+    if last < num_frames:
+        plan.append(('copy', last, num_frames))
+    return plan
+
+
+class _BitReader:
+    def __init__(self, rbsp: bytes):
+        self.value = int.from_bytes(rbsp, 'big')
+        self.left = len(rbsp) * 8
+
+    def u(self, n: int):
+        if n > self.left:
+            raise ValueError('Parameter set is truncated')
+        self.left -= n
+        return (self.value >> self.left) & ((1 << n) - 1)
+
+    def ue(self):
+        zeros = 0
+        while not self.u(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        k = self.ue()
+        return (k + 1) // 2 if k & 1 else -(k // 2)
+
+
+def parse_sps(nal: bytes, codec: str):
+    """Return (profile, chroma_format_idc, bit_depth_luma, bit_depth_chroma, width, height) of an SPS NAL unit."""
+    rbsp = nal.replace(b'\x00\x00\x03', b'\x00\x00')
+    if codec == 'hevc':
+        br = _BitReader(rbsp[2:])
+        br.u(4)
+        max_sub_layers_minus1 = br.u(3)
+        br.u(1)
+        br.u(3)
+        profile = br.u(5)
+        br.u(32)
+        br.u(48)
+        br.u(8)
+        sub_layer_flags = [(br.u(1), br.u(1)) for _ in range(max_sub_layers_minus1)]
+        if max_sub_layers_minus1 > 0:
+            br.u(2 * (8 - max_sub_layers_minus1))
+        for profile_present, level_present in sub_layer_flags:
+            if profile_present:
+                br.u(88)
+            if level_present:
+                br.u(8)
+        br.ue()
+        chroma_format_idc = br.ue()
+        if chroma_format_idc == 3:
+            br.u(1)
+        width, height = br.ue(), br.ue()
+        if br.u(1):
+            for _ in range(4):
+                br.ue()
+        return profile, chroma_format_idc, br.ue() + 8, br.ue() + 8, width, height
+
+    br = _BitReader(rbsp[1:])
+    profile = br.u(8)
+    br.u(16)
+    br.ue()
+    chroma_format_idc, bit_depth_luma, bit_depth_chroma = 1, 8, 8
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = br.ue()
+        if chroma_format_idc == 3:
+            br.u(1)
+        bit_depth_luma, bit_depth_chroma = br.ue() + 8, br.ue() + 8
+        br.u(1)
+        if br.u(1):
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if br.u(1):
+                    last, next_scale = 8, 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_scale:
+                            next_scale = (last + br.se() + 256) % 256
+                        last = next_scale or last
+    br.ue()
+    poc_type = br.ue()
+    if poc_type == 0:
+        br.ue()
+    elif poc_type == 1:
+        br.u(1)
+        br.se()
+        br.se()
+        for _ in range(br.ue()):
+            br.se()
+    br.ue()
+    br.u(1)
+    width_mbs, height_map_units = br.ue() + 1, br.ue() + 1
+    frame_mbs_only = br.u(1)
+    return profile, chroma_format_idc, bit_depth_luma, bit_depth_chroma, width_mbs * 16, (2 - frame_mbs_only) * height_map_units * 16
+
+
+class AnnexBStream:
+    """
+    Access units of a raw HEVC/AVC Annex-B stream, found by scanning NAL start codes over an mmap.
+    offsets[i] is the byte offset of access unit i, offsets[-1] the file size.
+    """
 
-            print(f"Running mkvmerge for new segment: mkvmerge -o \"_newseg.mkv\" \"_newseg{ext}\"")
-            os.system(f'mkvmerge -o "_newseg.mkv" "_newseg{ext}"')
+    # NAL types that may open a new access unit, and the parameter sets among them
+    PREFIX_TYPES = {
+        'hevc': {32, 33, 34, 35, 39, 41, 42, 43, 44} | set(range(48, 56)),
+        'avc': {6, 7, 8, 9, 14, 15, 16, 17, 18},
+    }
+    PARAM_SET_TYPES = {'hevc': (32, 33, 34), 'avc': (7, 8)}
+    SPS_TYPE = {'hevc': 33, 'avc': 7}
+
+    def __init__(self, path: str, codec: str):
+        self.path = path
+        self.codec = codec
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = array('Q')
+        self.keyframes = array('I')
+        self.sps = None
+        # param_sets[i] holds the active VPS/SPS/PPS NAL units from access unit param_set_aus[i] on
+        self.param_set_aus = array('I')
+        self.param_sets = []
+        self._scan()
+
+    def _scan(self):
+        data = self.data
+        hevc = self.codec == 'hevc'
+        prefix_types = self.PREFIX_TYPES[self.codec]
+        param_set_types = self.PARAM_SET_TYPES[self.codec]
+        current_sets = {}
+        au_has_vcl = False
+        pos = data.find(b'\x00\x00\x01')
+        while pos != -1:
+            nal_start = pos + 3
+            next_pos = data.find(b'\x00\x00\x01', nal_start)
+            nal_end = next_pos if next_pos != -1 else len(data)
+            if nal_start + 2 >= nal_end and (hevc or nal_start >= nal_end):
+                pos = next_pos
+                continue
+            au_start = pos - 1 if pos > 0 and data[pos - 1] == 0 else pos
+            if hevc:
+                nal_type = (data[nal_start] >> 1) & 0x3f
+                is_vcl = nal_type < 32
+                first_slice = is_vcl and data[nal_start + 2] & 0x80
+                is_keyframe = 16 <= nal_type <= 23
+            else:
+                nal_type = data[nal_start] & 0x1f
+                is_vcl = 1 <= nal_type <= 5
+                first_slice = is_vcl and nal_start + 1 < nal_end and data[nal_start + 1] & 0x80  # first_mb_in_slice == 0
+                is_keyframe = nal_type == 5
+
+            if not self.offsets or (au_has_vcl and (nal_type in prefix_types or first_slice)):
+                self.offsets.append(au_start)
+                au_has_vcl = False
+            if is_vcl:
+                if not au_has_vcl and is_keyframe:
+                    self.keyframes.append(len(self.offsets) - 1)
+                au_has_vcl = True
+            elif nal_type in param_set_types:
+                nal = data[nal_start:nal_end].rstrip(b'\x00')
+                current_sets[nal_type] = nal
+                if nal_type == self.SPS_TYPE[self.codec] and self.sps is None:
+                    self.sps = parse_sps(nal, self.codec)
+                au = len(self.offsets) - 1
+                if self.param_set_aus and self.param_set_aus[-1] == au:
+                    self.param_sets[-1] = dict(current_sets)
+                else:
+                    self.param_set_aus.append(au)
+                    self.param_sets.append(dict(current_sets))
+            pos = next_pos
+        self.offsets.append(len(data))
+        if self.sps is None:
+            raise ValueError(f'No SPS found in {self.path}, is it a raw {self.codec} stream?')
+
+    @property
+    def num_frames(self):
+        return len(self.offsets) - 1
+
+    def is_keyframe(self, au: int):
+        i = bisect_left(self.keyframes, au)
+        return i < len(self.keyframes) and self.keyframes[i] == au
+
+    def param_sets_for(self, au: int):
+        """Parameter sets to repeat in front of access unit au, or b'' if it carries its own."""
+        i = bisect_right(self.param_set_aus, au) - 1
+        if i < 0 or self.param_set_aus[i] == au:
+            return b''
+        sets = self.param_sets[i]
+        return b''.join(b'\x00\x00\x00\x01' + sets[t] for t in self.PARAM_SET_TYPES[self.codec] if t in sets)
+
+    def write_range(self, out, first_au: int, end_au: int, chunk_size: int = 64 * 1024 * 1024):
+        out.write(self.param_sets_for(first_au))
+        start, end = self.offsets[first_au], self.offsets[end_au]
+        while start < end:
+            n = min(chunk_size, end - start)
+            out.write(self.data[start:start + n])
+            start += n
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+def splice_annexb(fp_vc_input: str, codec: str, plan: list, seg_files: dict, fp_vc_output: str):
+    """
+    Write fp_vc_output in one sequential pass: untouched ranges copied from the input,
+    re-encoded ranges taken from seg_files[(l, r)]. Every boundary must be a keyframe
+    and every segment's SPS must match the input's.
+    """
+    source = AnnexBStream(fp_vc_input, codec)
+    segments = {}
+    try:
+        print(f"Input: {source.num_frames} access units, {len(source.keyframes)} keyframes, SPS {source.sps}")
+        if plan and plan[-1][2] != source.num_frames:
+            raise ValueError(f'Input has {source.num_frames} access units but ffprobe counted {plan[-1][2]} frames')
+        for kind, l, r in plan:
+            for boundary in (l, r):
+                if boundary < source.num_frames and not source.is_keyframe(boundary):
+                    raise ValueError(f'Frame {boundary} is not a keyframe, cannot splice there (use --force_expand)')
+        for (l, r), seg_file in seg_files.items():
+            segment = AnnexBStream(seg_file, codec)
+            segments[(l, r)] = segment
+            if segment.num_frames != r - l:
+                raise ValueError(f'Segment {l}-{r} has {segment.num_frames} frames, expected {r - l}')
+            if not segment.is_keyframe(0):
+                raise ValueError(f'Segment {l}-{r} does not start with a keyframe')
+            if segment.sps != source.sps:
+                raise ValueError(f'Segment {l}-{r} SPS {segment.sps} is not compatible with input SPS {source.sps}')
+
+        with open(fp_vc_output, 'wb') as out:
+            for kind, l, r in plan:
+                if kind == 'copy':
+                    source.write_range(out, l, r)
+                else:
+                    segments[(l, r)].write_range(out, 0, r - l)
+    finally:
+        source.close()
+        for segment in segments.values():
+            segment.close()
 
-            print(f"Merging segments: mkvmerge -o \"_lastseg.mkv\" \"_last.mkv\" + \"_newseg.mkv\"")
-            os.system(f'mkvmerge -o "_lastseg.mkv" "_last.mkv" + "_newseg.mkv"')
 
-        last_Iframe = Iframe2
+def load_keyframe_index(vc_filepath: str):
+    """
+    Return (num_frames, keyframes) for the first video stream, keyframes being a sorted array of frame numbers.
+    The index is cached next to the input as <input>.kfidx and rebuilt when the input's size or mtime changes.
+    """
+    st = os.stat(vc_filepath)
+    fp_index = vc_filepath + '.kfidx'
+    try:
+        with open(fp_index, 'rb') as f:
+            magic, size, mtime_ns, num_frames, count = KFIDX_HEADER.unpack(f.read(KFIDX_HEADER.size))
+            if magic == KFIDX_MAGIC and size == st.st_size and mtime_ns == st.st_mtime_ns:
+                keyframes = array('I')
+                keyframes.fromfile(f, count)
+                return num_frames, keyframes
+    except (OSError, struct.error, EOFError):
+        pass
+
+    num_frames, keyframes = build_keyframe_index(vc_filepath)
+    try:
+        with open(fp_index, 'wb') as f:
+            f.write(KFIDX_HEADER.pack(KFIDX_MAGIC, st.st_size, st.st_mtime_ns, num_frames, len(keyframes)))
+            keyframes.tofile(f)
+    except OSError as e:
+        print(f"Could not write keyframe index {fp_index}: {e}")
+    return num_frames, keyframes
+
+
+def build_keyframe_index(vc_filepath: str):
+    # Packets come in decode order. For closed GOP streams every keyframe starts a GOP,
+    # so its packet number is also its frame number.
+    print(f"Building keyframe index for {vc_filepath}")
+    proc = subprocess.Popen(
+        ['ffprobe', '-hide_banner', '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'packet=flags', '-of', 'csv=p=0', '-i', vc_filepath],
+        stdout=subprocess.PIPE
+    )
+    keyframes = array('I')
+    num_frames = 0
+    for line in proc.stdout:
+        if line.startswith(b'K'):
+            keyframes.append(num_frames)
+        num_frames += 1
+    if proc.wait() != 0 or num_frames == 0:
+        raise RuntimeError(f'ffprobe failed to read packets of {vc_filepath}')
+    return num_frames, keyframes
 
-    if last_Iframe != core.lsmas.LWLibavSource(file).num_frames:
-        print(f"Final mkvmerge for remaining frames: mkvmerge -o \"_newseg.mkv\" --split parts-frames:{last_Iframe+1}- \"{file}\"")
-        os.system(f'mkvmerge -o "_newseg.mkv" --split parts-frames:{last_Iframe+1}- "{file}"')
-        print(f"Merging final segments: mkvmerge -o \"_last.mkv\" \"_lastseg.mkv\" + \"_newseg.mkv\"")
-        os.system(f'mkvmerge -o "_last.mkv" "_lastseg.mkv" + "_newseg.mkv"')
-        print(f"Extracting final output: mkvextract \"_last.mkv\" tracks 0:\"{fp_vc_output}\"")
-        os.system(f'mkvextract "_last.mkv" tracks 0:"{fp_vc_output}"')
-    else:
-        print(f"Extracting final output (no remaining frames): mkvextract \"_lastseg.mkv\" tracks 0:\"{fp_vc_output}\"")
-        os.system(f'mkvextract "_lastseg.mkv" tracks 0:"{fp_vc_output}"')
-
-    print(f"Cleaning up temporary files...")
-    os.remove(file)
-    if qp:
-        os.remove("tmp_qp.qpfile")
-    os.remove(f"_newseg{ext}")
-    os.remove("_lastseg.mkv")
-    os.remove("_last.mkv")
-    os.remove("_newseg.mkv")
-    os.remove("_tomerge.mkv.lwi")
-    print("Cleanup completed.")
 
 def expand_segment_to_iframe(vc_filepath: str, segment_list: list):
-    import xml.etree.ElementTree as xet
-
-    os.system('ffprobe -hide_banner -v error -threads auto -show_frames -show_entries frame=key_frame ' +
-              f'-of xml -select_streams v:0 -i "{vc_filepath}" > tmp_frames.xml')
-    frames = xet.parse("tmp_frames.xml").getroot()[0]
-    num_frames = len(frames)
+    num_frames, keyframes = load_keyframe_index(vc_filepath)
     iseg_list = []
     for seg in segment_list:
         l, r = seg[0], seg[1]
         if l < 0 or l >= num_frames or r < 0 or r >= num_frames:
             raise ValueError(f'Invalid segment [{l}, {r}]')
-        while l > 0 and frames[l].attrib['key_frame'] != '1':
-            l -= 1
-        while r < num_frames and frames[r].attrib['key_frame'] != '1':
-            r += 1
+        i = bisect_right(keyframes, l) - 1
+        l = keyframes[i] if i >= 0 else 0
+        i = bisect_left(keyframes, r)
+        r = keyframes[i] if i < len(keyframes) else num_frames
         iseg_list += [[l, r]]
-    os.remove('tmp_frames.xml')
     return iseg_list
 
 
@@ -198,6 +722,13 @@ def main():
     parser.add_argument('--encoder', type=str, choices=['x264', 'x265'], default="x265", help="Select x264 or x265 encoder.")
     parser.add_argument('--qpfile', type=str, help="Path to the QP file (optional).")
     parser.add_argument('--force_expand', action='store_true', help="Force expand segments to I-frames.")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of segments to encode at the same time.")
+    parser.add_argument('--retries', type=int, default=1, help="How many times to retry a failed segment encode.")
+    parser.add_argument('--splice', action='store_true',
+                        help="Splice the raw bitstream directly instead of going through mkvmerge. Segment bounds must be keyframes.")
+    parser.add_argument('--verify', action='store_true',
+                        help="Check the frames around each re-encoded range against the input and the vpy.")
+    parser.add_argument('--tmpdir', type=str, help="Directory for small intermediates such as re-encoded segments and qpfiles, e.g. a tmpfs.")
 
     args = parser.parse_args()
 
@@ -212,7 +743,12 @@ def main():
         fp_vc_output=args.output,
         encoder=args.encoder,
         fp_qpfile=args.qpfile,
-        force_expand=args.force_expand
+        force_expand=args.force_expand,
+        jobs=args.jobs,
+        fp_tmpdir=args.tmpdir,
+        retries=args.retries,
+        splice=args.splice,
+        verify=args.verify
     )
 
 
@@ -12,10 +12,16 @@ import codecs
 from collections import defaultdict
 import os
 import datetime
-import ass
 from PIL import Image, ImageTk
 import threading
 import queue
+import argparse
+import sys
+from collections import OrderedDict
+import sqlite3
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import SimpleNamespace
 from ttkthemes import ThemedTk
 
 
@@ -33,6 +39,7 @@ class QueueHandler(logging.Handler):
 class PGSColorAnalyzer:
     def __init__(self, queue=None):
         self.framerate = 23.976
+        self.video_height = 0
         self.logger = logging.getLogger(__name__)
         self.queue = queue
 
@@ -51,14 +58,73 @@ class PGSColorAnalyzer:
         seconds = seconds % 60
         return f"{hours:d}:{minutes:02d}:{seconds:02.2f}"
 
-    def extract_outline_color(self, image: np.ndarray) -> Tuple[str, float]:
+    # 与 extract_outline_color 相同的白色判定和描边宽度
+    WHITE_LOWER = np.array([0, 0, 180])
+    WHITE_UPPER = np.array([180, 30, 255])
+    OUTLINE_KERNEL = np.ones((5, 5), np.uint8)
+    OUTLINE_ITERATIONS = 3
+    # 调色板快速路径中, 与主色距离在此范围内的颜色算作同一颜色
+    PALETTE_COLOR_TOLERANCE = 48
+    # 分析算法改变时递增, 使 ColorCache 中的旧结果失效
+    ANALYSIS_VERSION = 1
+
+    def analyze_image_file(self, image_path: str) -> Optional[Tuple[str, float, int]]:
+        """分析单张字幕图片, 返回 (颜色, 置信度, 描边像素数). 调色板PNG走快速路径, 其余用 k-means. 无法读取时返回None"""
+        try:
+            with Image.open(image_path) as image:
+                if image.mode == 'P':
+                    return self.extract_outline_color_palette(image)
+        except Exception as e:
+            self.logger.debug(f"Palette path unavailable for {image_path}: {str(e)}")
+        image = cv2.imread(str(image_path))
+        if image is None:
+            return None
+        return self.extract_outline_color(image)
+
+    def extract_outline_color_palette(self, image: Image.Image) -> Tuple[str, float, int]:
+        """
+        直接使用调色板索引: 白色判定只对256个调色板颜色做一次, 描边颜色由按透明度加权的索引直方图得出,
+        结果确定且不需要 k-means
+        """
+        try:
+            indices = np.asarray(image)
+            palette = np.zeros((256, 3), np.uint8)
+            palette_rgb = np.array(image.getpalette()[:768], np.uint8).reshape(-1, 3)
+            palette[:len(palette_rgb)] = palette_rgb
+
+            alpha = np.full(256, 255, np.int64)
+            transparency = image.info.get('transparency')
+            if isinstance(transparency, bytes):
+                alpha[:len(transparency)] = np.frombuffer(transparency, np.uint8)
+            elif isinstance(transparency, int):
+                alpha[transparency] = 0
+
+            hsv = cv2.cvtColor(palette[np.newaxis, :, ::-1].copy(), cv2.COLOR_BGR2HSV)
+            white_lut = cv2.inRange(hsv, self.WHITE_LOWER, self.WHITE_UPPER)[0]
+            white_mask = white_lut[indices]
+            dilated = cv2.dilate(white_mask, self.OUTLINE_KERNEL, iterations=self.OUTLINE_ITERATIONS)
+            outline = cv2.bitwise_xor(dilated, white_mask)
+
+            counts = np.bincount(indices[outline > 0], minlength=256)[:256]
+            weights = counts * alpha
+            total = weights.sum()
+            if total == 0:
+                return None, 0.0, 0
+
+            dominant = int(np.argmax(weights))
+            distance = np.linalg.norm(palette.astype(np.int32) - palette[dominant].astype(np.int32), axis=1)
+            confidence = weights[distance <= self.PALETTE_COLOR_TOLERANCE].sum() / total
+            r, g, b = palette[dominant]
+            return '#{:02x}{:02x}{:02x}'.format(r, g, b), float(confidence), int(counts[alpha > 0].sum())
+        except Exception as e:
+            self.logger.error(f"Palette color extraction failed: {str(e)}")
+        return None, 0.0, 0
+
+    def extract_outline_color(self, image: np.ndarray) -> Tuple[str, float, int]:
         try:
             hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-            lower_white = np.array([0, 0, 180])
-            upper_white = np.array([180, 30, 255])
-            white_mask = cv2.inRange(hsv, lower_white, upper_white)
-            kernel = np.ones((5,5), np.uint8)
-            dilated = cv2.dilate(white_mask, kernel, iterations=3)
+            white_mask = cv2.inRange(hsv, self.WHITE_LOWER, self.WHITE_UPPER)
+            dilated = cv2.dilate(white_mask, self.OUTLINE_KERNEL, iterations=self.OUTLINE_ITERATIONS)
             outline = cv2.bitwise_xor(dilated, white_mask)
             outline_colors = image[outline > 0]
 
@@ -78,80 +144,638 @@ class PGSColorAnalyzer:
                     int(dominant_color[1]),
                     int(dominant_color[0])
                 )
-                return color_hex, confidence
+                return color_hex, float(confidence), len(outline_colors)
         except Exception as e:
             self.logger.error(f"Color extraction failed: {str(e)}")
-        return None, 0.0
-
-    def parse_xml_and_analyze(self, xml_path: str, images_dir: str) -> List[Dict]:
+        return None, 0.0, 0
+
+    def parse_xml_and_analyze(self, xml_path: str, images_dir: str, workers: Optional[int] = None,
+                              executor: Optional[ProcessPoolExecutor] = None, use_cache: bool = True) -> List[Dict]:
+        """
+        解析XML, 图片分析分发到进程池, 结果按事件顺序返回. workers=1 时在当前进程内分析.
+        use_cache 时只分析 ColorCache 中没有的图片
+        """
         try:
-            tree = ET.parse(xml_path)
-            root = tree.getroot()
-            format_elem = root.find(".//Format")
-            if format_elem is not None:
-                framerate_str = format_elem.get('FrameRate')
-                if framerate_str:
-                    self.framerate = float(framerate_str)
-
-            results = []
-            images_path = Path(images_dir)
-            total_events = len(root.findall('.//Event'))
-
-            for i, event in enumerate(root.findall('.//Event'), 1):
-                if self.queue:
-                    self.update_progress(i * 100 / total_events)
-
-                in_time = event.get('InTC')
-                out_time = event.get('OutTC')
-                event_data = {
-                    'start': self.timecode_to_seconds(in_time),
-                    'end': self.timecode_to_seconds(out_time),
-                    'start_ass': self.seconds_to_ass_time(self.timecode_to_seconds(in_time)),
-                    'end_ass': self.seconds_to_ass_time(self.timecode_to_seconds(out_time)),
-                    'graphics': []
+            return [
+                {
+                    'start': event_data['start'],
+                    'end': event_data['end'],
+                    'start_ass': self.seconds_to_ass_time(event_data['start']),
+                    'end_ass': self.seconds_to_ass_time(event_data['end']),
+                    'graphics': event_data['graphics']
                 }
+                for event_data in self.iter_events(xml_path, images_dir, workers, executor, use_cache)
+            ]
+        except Exception as e:
+            self.logger.error(f"XML parsing failed: {str(e)}")
+            return None
+
+    def iter_events(self, xml_path: str, images_dir: str, workers: Optional[int] = None,
+                    executor: Optional[ProcessPoolExecutor] = None, use_cache: bool = True,
+                    batch_size: int = 1024):
+        """
+        用 iterparse 流式解析XML, 按顺序逐个产出事件 {'start', 'end', 'graphics'}.
+        已处理的元素随即释放, 图片每攒够 batch_size 张分析一次, 内存占用与XML大小无关
+        """
+        own_executor = executor is None and workers != 1
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        cache = None
+        if use_cache:
+            try:
+                cache = ColorCache(images_dir)
+            except sqlite3.Error as e:
+                self.logger.warning(f"Color cache unavailable: {str(e)}")
+
+        images_path = Path(images_dir)
+        batch = []
+        pending = []  # (event_data, graphic_data) 按顺序对应 image_paths
+        image_paths = []
+
+        def flush():
+            analyses = self._analyze_cached(image_paths, workers, executor, cache)
+            for (event_data, graphic_data), analysis in zip(pending, analyses):
+                if analysis is not None:
+                    graphic_data['color'], graphic_data['confidence'], graphic_data['outline_pixels'] = analysis
+                    event_data['graphics'].append(graphic_data)
+            events = list(batch)
+            batch.clear()
+            pending.clear()
+            image_paths.clear()
+            return events
 
-                for graphic in event.findall('Graphic'):
-                    image_filename = graphic.text
-                    image_path = images_path / image_filename
-                    if image_path.exists():
-                        image = cv2.imread(str(image_path))
-                        if image is not None:
-                            color, confidence = self.extract_outline_color(image)
-                            graphic_data = {
+        try:
+            with open(xml_path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size or 1
+                parents = []
+                for xml_event, elem in ET.iterparse(f, events=('start', 'end')):
+                    if xml_event == 'start':
+                        if elem.tag == 'Format' and elem.get('FrameRate'):
+                            self.framerate = float(elem.get('FrameRate'))
+                        if elem.tag == 'Format' and elem.get('VideoFormat'):
+                            match = re.match(r'\d+', elem.get('VideoFormat'))
+                            self.video_height = int(match.group()) if match else 0
+                        parents.append(elem)
+                        continue
+                    parents.pop()
+                    if elem.tag != 'Event':
+                        continue
+
+                    event_data = {
+                        'start': self.timecode_to_seconds(elem.get('InTC')),
+                        'end': self.timecode_to_seconds(elem.get('OutTC')),
+                        'graphics': []
+                    }
+                    batch.append(event_data)
+                    for graphic in elem.findall('Graphic'):
+                        image_filename = graphic.text
+                        image_path = images_path / image_filename
+                        if image_path.exists():
+                            pending.append((event_data, {
                                 'filename': image_filename,
                                 'width': int(graphic.get('Width')),
                                 'height': int(graphic.get('Height')),
                                 'x': int(graphic.get('X')),
                                 'y': int(graphic.get('Y')),
-                                'color': color,
-                                'confidence': confidence
-                            }
-                            event_data['graphics'].append(graphic_data)
-
-                results.append(event_data)
+                            }))
+                            image_paths.append(str(image_path))
+                    elem.clear()
+                    if parents:
+                        parents[-1].remove(elem)
+
+                    if len(image_paths) >= batch_size:
+                        if self.queue:
+                            self.update_progress(f.tell() * 100 / size)
+                        yield from flush()
+                yield from flush()
+                if self.queue:
+                    self.update_progress(100)
+        finally:
+            if cache:
+                cache.close()
+            if own_executor:
+                executor.shutdown()
+
+    def _analyze_cached(self, image_paths: List[str], workers: Optional[int] = None,
+                        executor: Optional[ProcessPoolExecutor] = None, cache: Optional['ColorCache'] = None):
+        """分析一批图片, 已在缓存中的直接取结果, 新结果写回缓存"""
+        analyses = [None] * len(image_paths)
+        misses = list(range(len(image_paths)))
+        if cache:
+            keys = [cache.key(image_path) for image_path in image_paths]
+            cached = cache.get_many(keys)
+            misses = [i for i, key in enumerate(keys) if key not in cached]
+            for i, key in enumerate(keys):
+                if key in cached:
+                    analyses[i] = cached[key]
+            self.logger.debug(f"Color cache: {len(image_paths) - len(misses)} hits, {len(misses)} to analyze")
+
+        new_items = []
+        for i, analysis in zip(misses, self._analyze_files([image_paths[i] for i in misses], workers, executor)):
+            analyses[i] = analysis
+            if cache and analysis is not None:
+                new_items.append((keys[i], analysis))
+        if cache and new_items:
+            cache.put_many(new_items)
+        return analyses
+
+    def _analyze_files(self, image_paths: List[str], workers: Optional[int] = None,
+                       executor: Optional[ProcessPoolExecutor] = None):
+        """按输入顺序逐个产出分析结果. 传入 executor 时 workers 为其进程数, 用于确定 chunksize"""
+        if executor is None and (workers == 1 or len(image_paths) < 2):
+            for image_path in image_paths:
+                yield self.analyze_image_file(image_path)
+            return
 
-            return results
-        except Exception as e:
-            self.logger.error(f"XML parsing failed: {str(e)}")
-            return None
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            n_workers = workers or os.cpu_count() or 1
+            chunksize = max(1, min(64, len(image_paths) // (n_workers * 8)))
+            yield from executor.map(_analyze_image_worker, image_paths, chunksize=chunksize)
+        finally:
+            if own_executor:
+                executor.shutdown()
 
     def save_results(self, results: List[Dict], output_path: str):
+        """保存为 {'video_height': 视频高度, 'events': 事件列表}"""
         try:
             with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(results, f, indent=2, ensure_ascii=False)
+                json.dump({'video_height': self.video_height, 'events': results}, f, indent=2, ensure_ascii=False)
             self.logger.info(f"Results saved to {output_path}")
         except Exception as e:
             self.logger.error(f"Failed to save results: {str(e)}")
 
+class ColorCache:
+    """
+    图片颜色分析结果的持久缓存, SQLite文件放在图片目录下.
+    键为图片内容的sha1加分析参数版本, 参数改变后旧结果自动失效
+    """
+
+    FILENAME = 'pgs_colors_cache.sqlite'
+
+    def __init__(self, images_dir: str):
+        self.path = os.path.join(images_dir, self.FILENAME)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS colors ('
+                          'key TEXT PRIMARY KEY, color TEXT, confidence REAL, outline_pixels INTEGER)')
+        self.version = hashlib.sha1(repr((
+            PGSColorAnalyzer.WHITE_LOWER.tolist(), PGSColorAnalyzer.WHITE_UPPER.tolist(),
+            PGSColorAnalyzer.OUTLINE_KERNEL.shape, PGSColorAnalyzer.OUTLINE_ITERATIONS,
+            PGSColorAnalyzer.PALETTE_COLOR_TOLERANCE, PGSColorAnalyzer.ANALYSIS_VERSION
+        )).encode()).hexdigest()[:12]
+
+    def key(self, image_path: str) -> str:
+        with open(image_path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest() + ':' + self.version
+
+    def get_many(self, keys: List[str]) -> Dict[str, Tuple[str, float, int]]:
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), 500):
+            batch = unique_keys[i:i + 500]
+            rows = self.conn.execute(
+                f'SELECT key, color, confidence, outline_pixels FROM colors WHERE key IN ({",".join("?" * len(batch))})',
+                batch)
+            for key, color, confidence, outline_pixels in rows:
+                found[key] = (color, confidence, outline_pixels)
+        return found
+
+    def put_many(self, items: List[Tuple[str, Tuple[str, float, int]]]):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO colors VALUES (?, ?, ?, ?)',
+                                  [(key, *analysis) for key, analysis in items])
+
+    def close(self):
+        self.conn.close()
+
+
+class PGSEventIndex:
+    """
+    PGS事件的区间索引. 事件按开始时间排序存为NumPy数组, 配合结束时间的前缀最大值,
+    两次 searchsorted 即可找出与任意时间段重叠的事件; 图形按CSR方式存放,
+    graphic_offsets[i]:graphic_offsets[i+1] 为第i个事件的图形
+    """
+    STANDARD_HEIGHTS = (480, 576, 720, 1080, 2160)
+    SPATIAL_TOLERANCE = 1 / 3  # 图形锚点与字幕锚点的最大距离, 按画面尺寸归一化
+
+    def __init__(self, capacity: int = 1024):
+        self.count = 0
+        self.graphic_count = 0
+        self.starts = np.empty(capacity, np.float64)
+        self.ends = np.empty(capacity, np.float64)
+        self.graphic_offsets = np.zeros(capacity + 1, np.int64)
+        self.color_ids = np.empty(capacity, np.int32)
+        self.confidences = np.empty(capacity, np.float32)
+        self.geometry = np.empty((capacity, 4), np.int32)  # x, y, width, height
+        self.filenames = []
+        self.colors = []
+        self.color_to_id = {}
+        self.video_height = 0  # 0 表示未知, 由图形位置推断
+        self.max_bottom = 0
+        self._sorted = True
+        self._max_ends = None
+
+    @classmethod
+    def from_events(cls, events) -> 'PGSEventIndex':
+        index = cls(max(1, len(events)) if isinstance(events, list) else 1024)
+        for event in events:
+            index.append(event)
+        return index
+
+    def save(self, path: str):
+        """保存为列式 npz 文件"""
+        self._prepare()
+        np.savez_compressed(
+            path,
+            starts=self.starts[:self.count],
+            ends=self.ends[:self.count],
+            graphic_offsets=self.graphic_offsets[:self.count + 1],
+            color_ids=self.color_ids[:self.graphic_count],
+            confidences=self.confidences[:self.graphic_count],
+            geometry=self.geometry[:self.graphic_count],
+            filenames=np.array(self.filenames, dtype=str),
+            colors=np.array(self.colors, dtype=str),
+            video_height=np.array(self.video_height),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'PGSEventIndex':
+        with np.load(path) as data:
+            index = cls(max(1, len(data['starts'])))
+            index.count = len(data['starts'])
+            index.graphic_count = len(data['color_ids'])
+            index.starts[:index.count] = data['starts']
+            index.ends[:index.count] = data['ends']
+            index.graphic_offsets[:index.count + 1] = data['graphic_offsets']
+            index._grow_graphics(max(1, index.graphic_count))
+            index.color_ids[:index.graphic_count] = data['color_ids']
+            index.confidences[:index.graphic_count] = data['confidences']
+            index.geometry[:index.graphic_count] = data['geometry']
+            index.filenames = data['filenames'].tolist()
+            index.colors = data['colors'].tolist()
+            if 'video_height' in data.files:
+                index.video_height = int(data['video_height'])
+            if index.graphic_count:
+                geometry = index.geometry[:index.graphic_count]
+                index.max_bottom = int((geometry[:, 1] + geometry[:, 3]).max())
+        index.color_to_id = {color: i for i, color in enumerate(index.colors)}
+        return index
+
+    def _grow_events(self):
+        capacity = len(self.starts) * 2
+        self.starts = np.resize(self.starts, capacity)
+        self.ends = np.resize(self.ends, capacity)
+        offsets = np.zeros(capacity + 1, np.int64)
+        offsets[:self.count + 1] = self.graphic_offsets[:self.count + 1]
+        self.graphic_offsets = offsets
+
+    def _grow_graphics(self, needed: int):
+        capacity = len(self.color_ids)
+        while capacity < needed:
+            capacity *= 2
+        self.color_ids = np.resize(self.color_ids, capacity)
+        self.confidences = np.resize(self.confidences, capacity)
+        self.geometry = np.resize(self.geometry, (capacity, 4))
+
+    def append(self, event: Dict):
+        """追加一个 parse_xml_and_analyze 格式的事件"""
+        if self.count == len(self.starts):
+            self._grow_events()
+        graphics = event['graphics']
+        if self.graphic_count + len(graphics) > len(self.color_ids):
+            self._grow_graphics(self.graphic_count + len(graphics))
+
+        if self.count and event['start'] < self.starts[self.count - 1]:
+            self._sorted = False
+        self.starts[self.count] = event['start']
+        self.ends[self.count] = event['end']
+        for graphic in graphics:
+            color = graphic.get('color')
+            if color is None:
+                color_id = -1
+            else:
+                color_id = self.color_to_id.get(color)
+                if color_id is None:
+                    color_id = self.color_to_id[color] = len(self.colors)
+                    self.colors.append(color)
+            g = self.graphic_count
+            self.color_ids[g] = color_id
+            self.confidences[g] = graphic.get('confidence', 0)
+            self.geometry[g] = (graphic['x'], graphic['y'], graphic['width'], graphic['height'])
+            self.max_bottom = max(self.max_bottom, graphic['y'] + graphic['height'])
+            self.filenames.append(graphic['filename'])
+            self.graphic_count += 1
+        self.count += 1
+        self.graphic_offsets[self.count] = self.graphic_count
+        if not self._sorted:
+            self._max_ends = None
+
+    def frame_size(self) -> Tuple[int, int]:
+        """视频画面尺寸. XML未注明时取能容纳全部图形的标准高度, 至少1080"""
+        height = self.video_height
+        if not height:
+            height = next((h for h in self.STANDARD_HEIGHTS if h >= max(self.max_bottom, 1080)), self.max_bottom)
+        width = 720 if height in (480, 576) else height * 16 // 9
+        return width, height
+
+    def _prepare(self):
+        if not self._sorted:
+            order = np.argsort(self.starts[:self.count], kind='stable')
+            counts = np.diff(self.graphic_offsets[:self.count + 1])[order]
+            graphic_order = self._graphic_indices(self.graphic_offsets[:self.count][order], counts)
+            self.starts[:self.count] = self.starts[:self.count][order]
+            self.ends[:self.count] = self.ends[:self.count][order]
+            self.graphic_offsets[1:self.count + 1] = np.cumsum(counts)
+            self.color_ids[:self.graphic_count] = self.color_ids[graphic_order]
+            self.confidences[:self.graphic_count] = self.confidences[graphic_order]
+            self.geometry[:self.graphic_count] = self.geometry[graphic_order]
+            self.filenames = [self.filenames[g] for g in graphic_order]
+            self._sorted = True
+        if self._max_ends is None:
+            self._max_ends = np.maximum.accumulate(self.ends[:self.count])
+        elif len(self._max_ends) < self.count:
+            # 按时间顺序追加时只需延续已有的前缀最大值
+            tail = self.ends[len(self._max_ends) - 1:self.count].copy()
+            tail[0] = self._max_ends[-1]
+            self._max_ends = np.concatenate((self._max_ends, np.maximum.accumulate(tail)[1:]))
+
+    @staticmethod
+    def _graphic_indices(first: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """把每个事件的 [first, first+count) 图形区间展开为一个下标数组"""
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, np.int64)
+        group_starts = np.cumsum(counts) - counts
+        return np.repeat(first - group_starts, counts) + np.arange(total)
+
+    def overlapping(self, start: float, end: float) -> Tuple[np.ndarray, np.ndarray]:
+        """返回与 (start, end) 有正重叠的事件下标及各自的重叠时长"""
+        self._prepare()
+        hi = np.searchsorted(self.starts[:self.count], end, 'left')
+        lo = np.searchsorted(self._max_ends, start, 'right')
+        events = np.arange(lo, max(lo, hi))
+        overlaps = np.minimum(self.ends[events], end) - np.maximum(self.starts[events], start)
+        keep = overlaps > 0
+        return events[keep], overlaps[keep]
+
+    def graphics_of(self, events: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """返回这些事件的全部图形下标, 以及每个图形所属的是第几个输入事件"""
+        first = self.graphic_offsets[events]
+        counts = self.graphic_offsets[events + 1] - first
+        return self._graphic_indices(first, counts), np.repeat(np.arange(len(events)), counts)
+
+    def nearest_graphics(self, graphics: np.ndarray, owner: np.ndarray,
+                         placement: Tuple[int, float, float, bool]) -> np.ndarray:
+        """
+        按字幕位置筛选图形: 每个事件只保留锚点离字幕锚点最近且在容差内的图形.
+        placement 为 ASSFile.placement 的结果, 图形锚点取与字幕对齐方式相同的边
+        """
+        alignment, anchor_x, anchor_y, has_pos = placement
+        width, height = self.frame_size()
+        column, row = (alignment - 1) % 3, (alignment - 1) // 3
+        geometry = self.geometry[graphics].astype(np.float64)
+        graphic_x = (geometry[:, 0] + geometry[:, 2] * column / 2) / width
+        graphic_y = (geometry[:, 1] + geometry[:, 3] * (2 - row) / 2) / height
+        distances = np.abs(graphic_y - anchor_y)
+        if has_pos:
+            distances = np.hypot(graphic_x - anchor_x, distances)
+        nearest = np.full(int(owner.max()) + 1 if len(owner) else 0, np.inf)
+        np.minimum.at(nearest, owner, distances)
+        return (distances <= nearest[owner]) & (distances <= self.SPATIAL_TOLERANCE)
+
+    def color_durations(self, start: float, end: float, images_dir: str, min_confidence: float = 0.5,
+                        placement: Optional[Tuple[int, float, float, bool]] = None
+                        ) -> Dict[str, Dict[str, Union[float, List[str]]]]:
+        """
+        按颜色统计与 (start, end) 重叠的时长占比及对应图片, 格式同 ASSColorUpdater._calculate_color_duration.
+        给出 placement 且涉及多种颜色时只统计位置与字幕相符的图形, 没有相符的图形时退回统计全部
+        """
+        total_duration = end - start
+        if total_duration <= 0:
+            return {}
+        events, overlaps = self.overlapping(start, end)
+        graphics, owner = self.graphics_of(events)
+        color_ids = self.color_ids[graphics]
+        keep = (self.confidences[graphics] > min_confidence) & (color_ids >= 0)
+        graphics, color_ids, owner = graphics[keep], color_ids[keep], owner[keep]
+        if len(graphics) == 0:
+            return {}
+        if placement is not None and (color_ids != color_ids[0]).any():
+            near = self.nearest_graphics(graphics, owner, placement)
+            if near.any():
+                graphics, color_ids, owner = graphics[near], color_ids[near], owner[near]
+        weights = overlaps[owner]
+
+        durations = np.bincount(color_ids, weights=weights, minlength=len(self.colors))
+        images = defaultdict(set)
+        for g, color_id in zip(graphics.tolist(), color_ids.tolist()):
+            images[color_id].add(os.path.join(images_dir, self.filenames[g]))
+        return {
+            self.colors[color_id]: {
+                'percentage': durations[color_id] / total_duration,
+                'images': sorted(images[color_id])
+            }
+            for color_id in images
+        }
+
+
+_worker_analyzer = None
+
+
+def _analyze_image_worker(image_path: str) -> Optional[Tuple[str, float, int]]:
+    """进程池工作函数, 每个进程复用一个分析器"""
+    global _worker_analyzer
+    if _worker_analyzer is None:
+        _worker_analyzer = PGSColorAnalyzer()
+    return _worker_analyzer.analyze_image_file(image_path)
+
+
+class ASSFile:
+    """
+    按行读写ASS文件, 只解析 [Events] 中 Dialogue 行的时间, 样式和文本字段.
+    其余内容 (包括BOM和换行符) 原样保留, 保存时一次写出
+    """
+    DEFAULT_EVENT_FORMAT = ['Layer', 'Start', 'End', 'Style', 'Name',
+                            'MarginL', 'MarginR', 'MarginV', 'Effect', 'Text']
+    LINE_PATTERN = re.compile(r'[^\n]*\n|[^\n]+')
+    TIME_PATTERN = re.compile(r'(\d+):(\d+):(\d+(?:\.\d*)?)')
+    OVERRIDE_PATTERN = re.compile(r'\{[^}]*\}')
+    ALIGNMENT_PATTERN = re.compile(r'\\an([1-9])|\\a(\d+)')
+    POS_PATTERN = re.compile(r'\\pos\(\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*\)')
+    # 旧式 \a 对齐值到 \an 的对应
+    LEGACY_ALIGNMENT = {1: 1, 2: 2, 3: 3, 5: 7, 6: 8, 7: 9, 9: 4, 10: 5, 11: 6}
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.bom = data.startswith(codecs.BOM_UTF8)
+        self.lines = self.LINE_PATTERN.findall(data.decode('utf-8-sig'))
+        self.dialogues = []
+        self.script_info = {}
+        self.styles = {}
+        self._parse()
+
+    def _parse_time(self, value: str) -> datetime.timedelta:
+        match = self.TIME_PATTERN.fullmatch(value.strip())
+        if not match:
+            raise ValueError(f"Invalid ASS time: {value}")
+        hours, minutes, seconds = match.groups()
+        return datetime.timedelta(hours=int(hours), minutes=int(minutes), seconds=float(seconds))
+
+    def _parse(self):
+        section = None
+        fields = self.DEFAULT_EVENT_FORMAT
+        style_fields = []
+        for i, line in enumerate(self.lines):
+            content = line.rstrip('\r\n')
+            stripped = content.strip()
+            if stripped.startswith('[') and stripped.endswith(']'):
+                section = stripped.lower()
+                continue
+            key, sep, value = content.partition(':')
+            if not sep:
+                continue
+            key = key.strip()
+            if section == '[script info]':
+                self.script_info[key] = value.strip()
+                continue
+            if section in ('[v4+ styles]', '[v4 styles]'):
+                if key == 'Format':
+                    style_fields = [field.strip() for field in value.split(',')]
+                elif key == 'Style' and style_fields:
+                    style = dict(zip(style_fields, (v.strip() for v in value.split(',', len(style_fields) - 1))))
+                    if section == '[v4 styles]' and style.get('Alignment', '').isdigit():
+                        # SSA 样式的 Alignment 是旧式 \a 编号, 统一换算为 \an
+                        style['Alignment'] = str(self.LEGACY_ALIGNMENT.get(int(style['Alignment']), 2))
+                    self.styles[style.get('Name', '')] = style
+                continue
+            if section != '[events]':
+                continue
+            if key == 'Format':
+                fields = [field.strip() for field in value.split(',')]
+            elif key == 'Dialogue':
+                values = value.split(',', len(fields) - 1)
+                if len(values) != len(fields):
+                    raise ValueError(f"Malformed Dialogue at line {i + 1}")
+                row = dict(zip(fields, values))
+                # Text 总是最后一个字段, 之前的部分保存时原样写回
+                text = values[-1]
+                self.dialogues.append(SimpleNamespace(
+                    start=self._parse_time(row['Start']),
+                    end=self._parse_time(row['End']),
+                    style=row.get('Style', '').strip(),
+                    text=text,
+                    line=i,
+                    prefix=content[:len(content) - len(text)],
+                    newline=line[len(content):],
+                    margins=tuple(row.get(field, '0').strip() for field in ('MarginL', 'MarginR', 'MarginV'))
+                ))
+
+    def play_res(self) -> Tuple[int, int]:
+        def to_int(value):
+            try:
+                return int(float(value))
+            except (TypeError, ValueError):
+                return 0
+        width = to_int(self.script_info.get('PlayResX'))
+        height = to_int(self.script_info.get('PlayResY'))
+        if not width and not height:
+            return 384, 288
+        return width or height * 4 // 3, height or width * 3 // 4
+
+    def placement(self, dialogue) -> Tuple[int, float, float, bool]:
+        """
+        计算对话行的显示位置, 返回 (对齐方式1-9, 锚点x, 锚点y, 是否由\\pos指定).
+        锚点按 PlayRes 归一化到 0~1; 没有 \\pos 时由对齐方式和边距得出
+        """
+        style = self.styles.get(dialogue.style) or self.styles.get('Default') or {}
+        try:
+            alignment = int(style.get('Alignment', 2))
+        except ValueError:
+            alignment = 2
+        if alignment not in range(1, 10):
+            alignment = 2
+        # 同一行中 \\an 和 \\pos 都以第一次出现的为准
+        override, pos = None, None
+        for block in self.OVERRIDE_PATTERN.findall(dialogue.text):
+            match = self.ALIGNMENT_PATTERN.search(block)
+            if match and override is None:
+                override = int(match.group(1)) if match.group(1) else self.LEGACY_ALIGNMENT.get(int(match.group(2)))
+            match = self.POS_PATTERN.search(block)
+            if match and pos is None:
+                pos = float(match.group(1)), float(match.group(2))
+        alignment = override or alignment
+
+        width, height = self.play_res()
+        if pos is not None:
+            return alignment, pos[0] / width, pos[1] / height, True
+
+        margins = []
+        for field, value in zip(('MarginL', 'MarginR', 'MarginV'), dialogue.margins):
+            try:
+                margin = int(value)
+            except ValueError:
+                margin = 0
+            if not margin:
+                try:
+                    margin = int(style.get(field, 0))
+                except ValueError:
+                    margin = 0
+            margins.append(margin)
+        margin_l, margin_r, margin_v = margins
+        column, row = (alignment - 1) % 3, (alignment - 1) // 3
+        x = (margin_l, (margin_l + width - margin_r) / 2, width - margin_r)[column]
+        y = (height - margin_v, height / 2, margin_v)[row]
+        return alignment, x / width, y / height, False
+
+    def dump(self) -> str:
+        lines = list(self.lines)
+        for dialogue in self.dialogues:
+            lines[dialogue.line] = dialogue.prefix + dialogue.text + dialogue.newline
+        return ''.join(lines)
+
+    def save(self, path: str):
+        data = self.dump().encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(codecs.BOM_UTF8 + data if self.bom else data)
+
+
 class ASSColorUpdater:
-    def __init__(self, ass_path: str, colors_json_path: str, images_dir: str, queue=None, preview_callback=None):
+    def __init__(self, ass_path: str, colors: Union[str, List[Dict]], images_dir: str, queue=None, preview_callback=None,
+                 spatial: bool = True, analyzer: Optional[PGSColorAnalyzer] = None):
+        """
+        colors 可以是颜色JSON路径, 也可以直接是 parse_xml_and_analyze 的结果.
+        spatial 时按字幕的对齐, 边距和 \\pos 只统计位置相符的PGS图形.
+        analyzer 为产生 colors 的分析器, 从中读取XML注明的视频高度 (流式解析时读到 Format 后才有)
+        """
         self.logger = logging.getLogger(__name__)
         self.ass_doc = self._load_ass(ass_path)
-        self.colors = self._load_colors(colors_json_path)
+        video_height = 0
+        if isinstance(colors, (str, Path)):
+            colors = PGSEventIndex.load(str(colors)) if str(colors).endswith('.npz') else self._load_colors(colors)
+        if isinstance(colors, dict):
+            video_height = colors.get('video_height') or 0
+            colors = colors['events']
+        self.colors = colors
+        self.analyzer = analyzer
+        self._event_stream = None
+        if isinstance(colors, PGSEventIndex):
+            self.event_index = colors
+        elif isinstance(colors, list):
+            self.event_index = PGSEventIndex.from_events(colors)
+        else:
+            # 事件流 (如 iter_events), 按需读取, 要求按开始时间排序
+            self.event_index = PGSEventIndex()
+            self._event_stream = iter(colors)
+        if video_height:
+            self.event_index.video_height = video_height
+        self._sync_video_height()
         self.images_dir = images_dir
         self.queue = queue
         self.preview_callback = preview_callback
+        self.spatial = spatial
         self.color_selection_event = threading.Event()
         self.selected_color = None
 
@@ -163,15 +787,14 @@ class ASSColorUpdater:
         centiseconds = int((td.total_seconds() * 100) % 100)
         return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
 
-    def _load_ass(self, ass_path: str) -> ass.Document:
+    def _load_ass(self, ass_path: str) -> ASSFile:
         try:
-            with codecs.open(ass_path, 'r', encoding='utf-8-sig') as f:
-                return ass.parse(f)
+            return ASSFile(ass_path)
         except Exception as e:
             self.logger.error(f"Failed to load ASS file: {str(e)}")
             raise
 
-    def _load_colors(self, colors_json_path: str) -> List[Dict]:
+    def _load_colors(self, colors_json_path: str) -> Union[Dict, List[Dict]]:
         try:
             with codecs.open(colors_json_path, 'r', encoding='utf-8-sig') as f:
                 return json.load(f)
@@ -188,31 +811,25 @@ class ASSColorUpdater:
             self.logger.error(f"Invalid color format: {hex_color} {e}")
             return "&H000000&"
 
-    def _calculate_color_duration(self, start_time: float, end_time: float,
-                                color_events: List[Dict]) -> Dict[str, Dict[str, Union[float, List[str]]]]:
-        color_info = defaultdict(lambda: {'duration': 0.0, 'images': set()})
-        total_duration = end_time - start_time
-
-        for event in color_events:
-            event_start = max(event['start'], start_time)
-            event_end = min(event['end'], end_time)
-            if event_end > event_start:
-                for graphic in event['graphics']:
-                    if graphic.get('confidence', 0) > 0.5:
-                        duration = event_end - event_start
-                        color = graphic['color']
-                        if color:  # Check if color is not None
-                            color_info[color]['duration'] += duration
-                            color_info[color]['images'].add(os.path.join(self.images_dir, graphic['filename']))
+    def _sync_video_height(self):
+        if self.analyzer and self.analyzer.video_height and not self.event_index.video_height:
+            self.event_index.video_height = self.analyzer.video_height
 
-        return {
-            color: {
-                'percentage': info['duration']/total_duration,
-                'images': sorted(list(info['images']))
-            }
-            for color, info in color_info.items()
-            if color is not None  # Filter out None colors
-        }
+    def _pull_events(self, end_time: float):
+        """从事件流读取, 直到读到开始时间晚于 end_time 的事件"""
+        index = self.event_index
+        while self._event_stream is not None and (index.count == 0 or index.starts[index.count - 1] <= end_time):
+            try:
+                index.append(next(self._event_stream))
+            except StopIteration:
+                self._event_stream = None
+        self._sync_video_height()
+
+    def _calculate_color_duration(self, start_time: float, end_time: float,
+                                  placement: Optional[Tuple[int, float, float, bool]] = None
+                                  ) -> Dict[str, Dict[str, Union[float, List[str]]]]:
+        self._pull_events(end_time)
+        return self.event_index.color_durations(start_time, end_time, self.images_dir, placement=placement)
 
     def wait_for_color_selection(self):
         self.color_selection_event.wait()
@@ -228,16 +845,13 @@ class ASSColorUpdater:
         self.selected_color = "SKIP"
         self.color_selection_event.set()
 
-    def _find_color_at_time(self, start_time: float, end_time: float) -> Optional[Tuple[str, Dict]]:
-        relevant_events = [
-            event for event in self.colors
-            if event['start'] <= end_time and event['end'] >= start_time
-        ]
-
-        if not relevant_events:
-            return None
-
-        color_info = self._calculate_color_duration(start_time, end_time, relevant_events)
+    def _auto_color(self, start_time: float, end_time: float,
+                    placement: Optional[Tuple[int, float, float, bool]] = None) -> Optional[Tuple[Optional[str], Dict]]:
+        """
+        不需要人工参与的判定: 无颜色信息返回None, 能自动确定时返回 (颜色, {}),
+        否则返回 (None, color_info) 交由人工选择
+        """
+        color_info = self._calculate_color_duration(start_time, end_time, placement)
 
         if not color_info:
             return None
@@ -252,6 +866,15 @@ class ASSColorUpdater:
         if dominant_color[1]['percentage'] >= 0.8:
             return dominant_color[0], {}
 
+        return None, color_info
+
+    def _find_color_at_time(self, start_time: float, end_time: float,
+                            placement: Optional[Tuple[int, float, float, bool]] = None) -> Optional[Tuple[str, Dict]]:
+        result = self._auto_color(start_time, end_time, placement)
+        if not result or result[0]:
+            return result
+        color_info = result[1]
+
         # 如果有预览回调函数，发送预览信息并等待选择
         if self.preview_callback and self.queue:
             event_data = self._get_current_event()
@@ -273,13 +896,10 @@ class ASSColorUpdater:
 
     def update_dialogues_colors(self):
         updated_count = 0
-        total_dialogues = len([e for e in self.ass_doc.events if isinstance(e, ass.Dialogue)])
+        total_dialogues = len(self.ass_doc.dialogues)
         current_dialogue = 0
 
-        for event in self.ass_doc.events:
-            if not isinstance(event, ass.Dialogue):
-                continue
-
+        for event in self.ass_doc.dialogues:
             self._current_event = event  # 保存当前正在处理的事件
             current_dialogue += 1
             if self.queue:
@@ -288,7 +908,8 @@ class ASSColorUpdater:
             start_time = event.start.total_seconds()
             end_time = event.end.total_seconds()
 
-            result = self._find_color_at_time(start_time, end_time)
+            placement = self.ass_doc.placement(event) if self.spatial else None
+            result = self._find_color_at_time(start_time, end_time, placement)
             if not result:
                 continue
 
@@ -304,12 +925,55 @@ class ASSColorUpdater:
         if self.queue:
             self.queue.put(("log", f"Total updated dialogues: {updated_count}"))
 
+    def scan_dialogues(self) -> Tuple[Dict[str, str], Dict[str, Dict]]:
+        """
+        批量模式第一阶段: 只做自动判定, 不等待人工选择.
+        返回 (自动决定 {对话序号: 颜色}, 待决定 {对话序号: 行信息和候选颜色})
+        """
+        decisions = {}
+        ambiguities = {}
+        dialogues = self.ass_doc.dialogues
+        for i, event in enumerate(dialogues):
+            start_time = event.start.total_seconds()
+            end_time = event.end.total_seconds()
+            placement = self.ass_doc.placement(event) if self.spatial else None
+            result = self._auto_color(start_time, end_time, placement)
+            if not result:
+                continue
+            color, color_info = result
+            if color:
+                decisions[str(i)] = color
+            else:
+                ambiguities[str(i)] = {
+                    'start': start_time,
+                    'end': end_time,
+                    'style': event.style,
+                    'text': event.text,
+                    'colors': color_info,
+                    'choice': None
+                }
+        return decisions, ambiguities
+
+    def apply_decisions(self, decisions: Dict[str, str]) -> int:
+        """按 {对话序号: 颜色} 修改对话行, 返回修改行数"""
+        updated_count = 0
+        dialogues = self.ass_doc.dialogues
+        for key, color in decisions.items():
+            event = dialogues[int(key)]
+            event.text = self._update_dialogue_text(event.text, self._hex_to_ass_color(color))
+            updated_count += 1
+        if self.queue:
+            self.queue.put(("log", f"Total updated dialogues: {updated_count}"))
+        return updated_count
+
+    COLOR_TAG_PATTERN = re.compile(r'\\3c&H[0-9A-Fa-f]{6}&')
+
     def _update_dialogue_text(self, text: str, new_color: str) -> str:
         color_tag = f"\\3c{new_color}"
 
         try:
             if "\\3c" in text:
-                text = re.sub(r'\\3c&H[0-9A-Fa-f]{6}&', lambda m: color_tag, text)
+                text = self.COLOR_TAG_PATTERN.sub(lambda m: color_tag, text)
             else:
                 if text.startswith('{'):
                     bracket_end = text.find('}')
@@ -328,8 +992,7 @@ class ASSColorUpdater:
         
     def save(self, output_path: str):
         try:
-            with codecs.open(output_path, 'w', encoding='utf-8-sig') as f:
-                self.ass_doc.dump_file(f)
+            self.ass_doc.save(output_path)
             if self.queue:
                 self.queue.put(("log", f"Saved updated ASS to {output_path}"))
         except Exception as e:
@@ -337,7 +1000,86 @@ class ASSColorUpdater:
                 self.queue.put(("error", f"Failed to save ASS file: {str(e)}"))
             raise
     
+class ThumbnailCache:
+    """
+    预览缩略图的LRU缓存, 以 (路径, 尺寸) 为键保存缩放好的PIL图片.
+    缩放在后台线程池中进行, Tk线程只需创建 PhotoImage
+    """
+
+    def __init__(self, capacity: int = 512, workers: int = 4):
+        self.capacity = capacity
+        self.images = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.logger = logging.getLogger(__name__)
+
+    def _render(self, image_path: str, max_size: Tuple[int, int]) -> Optional[Image.Image]:
+        try:
+            with Image.open(image_path) as image:
+                # 如果是调色板模式，转换为RGB
+                if image.mode in ('P', 'PA'):
+                    image = image.convert('RGBA')
+                else:
+                    image = image.copy()
+                orig_width, orig_height = image.size
+                # 计算缩放比例，保持原始比例
+                scale = min(max_size[0]/orig_width, max_size[1]/orig_height, 1.0)
+                if scale != 1.0:
+                    if image.mode != 'RGB':
+                        image = image.convert('RGB')
+                    image = image.resize((int(orig_width * scale), int(orig_height * scale)), Image.LANCZOS)
+                return image
+        except Exception as e:
+            self.logger.error(f"Failed to create image preview: {str(e)}")
+            return None
+
+    def _store(self, key, future):
+        image = future.result()
+        with self.lock:
+            self.pending.pop(key, None)
+            if image is None:
+                return
+            self.images[key] = image
+            self.images.move_to_end(key)
+            while len(self.images) > self.capacity:
+                self.images.popitem(last=False)
+
+    def request(self, image_path: str, max_size: Tuple[int, int]):
+        """在后台生成缩略图 (已缓存或已在生成中则忽略)"""
+        key = (image_path, tuple(max_size))
+        with self.lock:
+            if key in self.images or key in self.pending:
+                return
+            future = self.executor.submit(self._render, image_path, tuple(max_size))
+            self.pending[key] = future
+        future.add_done_callback(lambda f: self._store(key, f))
+
+    def prefetch(self, image_paths: List[str], max_size: Tuple[int, int]):
+        for image_path in image_paths:
+            self.request(image_path, max_size)
+
+    def get(self, image_path: str, max_size: Tuple[int, int]) -> Optional[Image.Image]:
+        """取缩略图, 尚未生成时等待后台结果"""
+        key = (image_path, tuple(max_size))
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                return image
+            future = self.pending.get(key)
+        if future is None:
+            return self._render(image_path, tuple(max_size))
+        return future.result()
+
+
 class PGSASSColorGUI:
+    # 每种颜色最多显示的图片数, 及缩略图尺寸
+    MAX_IMAGES_PER_COLOR = 8
+    THUMBNAIL_SIZE = (200, 150)
+    # 批量模式中提前生成缩略图的待决定行数
+    PREFETCH_LINES = 3
+
     def __init__(self):
         self.root = ThemedTk(theme="equilux")
         self.root.title("PGS/ASS 字幕颜色处理工具")
@@ -353,6 +1095,11 @@ class PGSASSColorGUI:
         self.output_path = tk.StringVar()
         self.save_json = tk.StringVar()
         self.current_updater = None
+        self.thumbnails = ThumbnailCache()
+        # 批量模式: scan 生成的待决定文件及尚未决定的 (组序号, 对话序号)
+        self.batch_path = None
+        self.batch_data = None
+        self.batch_pending = []
         
         # 创建界面
         self.create_gui()
@@ -426,6 +1173,11 @@ class PGSASSColorGUI:
         ttk.Entry(file_frame, textvariable=self.output_path).grid(row=3, column=1, sticky="ew", padx=5)
         ttk.Button(file_frame, text="浏览", command=lambda: self.browse_file("output")).grid(row=3, column=2)
         
+        # 颜色JSON保存 (可选)
+        ttk.Label(file_frame, text="颜色JSON(可选):").grid(row=4, column=0, sticky="w")
+        ttk.Entry(file_frame, textvariable=self.save_json).grid(row=4, column=1, sticky="ew", padx=5)
+        ttk.Button(file_frame, text="浏览", command=lambda: self.browse_file("json")).grid(row=4, column=2)
+        
         file_frame.grid_columnconfigure(1, weight=1)
         
         # 控制区域
@@ -434,6 +1186,8 @@ class PGSASSColorGUI:
         
         ttk.Button(control_frame, text="开始处理", command=self.start_processing).pack(side=tk.LEFT, padx=5)
         ttk.Button(control_frame, text="停止处理", command=self.stop_processing).pack(side=tk.LEFT, padx=5)
+        ttk.Button(control_frame, text="载入待决定", command=self.load_ambiguities).pack(side=tk.LEFT, padx=5)
+        ttk.Button(control_frame, text="应用决定", command=self.apply_ambiguities).pack(side=tk.LEFT, padx=5)
         
         # 进度条
         self.progress = ttk.Progressbar(control_frame, mode='determinate')
@@ -559,9 +1313,9 @@ class PGSASSColorGUI:
             row_width = 0
             max_width = self.colors_frame_inner.winfo_width() - 20  # 留出一些边距
             
-            for img_path in info['images']:
+            for img_path in info['images'][:self.MAX_IMAGES_PER_COLOR]:
                 # 创建预览
-                photo = self.create_image_preview(img_path, (200, 150))  # 控制最大尺寸
+                photo = self.create_image_preview(img_path, self.THUMBNAIL_SIZE)  # 控制最大尺寸
                 if photo:
                     if row_width + photo.width() > max_width and row_width > 0:
                         # 创建新行
@@ -585,62 +1339,125 @@ class PGSASSColorGUI:
                             ).pack()
                     
                     row_width += photo.width() + 4  # 加上padding
+
+            if len(info['images']) > self.MAX_IMAGES_PER_COLOR:
+                ttk.Label(images_frame,
+                        text=f"另有 {len(info['images']) - self.MAX_IMAGES_PER_COLOR} 张图片未显示"
+                        ).pack(anchor=tk.W)
         
         # 更新主画布滚动区域
         self.colors_frame_inner.update_idletasks()
         self.colors_canvas.configure(scrollregion=self.colors_canvas.bbox("all"))
 
     def create_image_preview(self, image_path, max_size=(200, 150)):
-        """创建自适应大小的图片预览"""
-        try:
-            # 使用PIL打开图片
-            image = Image.open(image_path)
-            
-            # 如果是调色板模式，转换为RGB
-            if image.mode in ('P', 'PA'):
-                image = image.convert('RGBA')
-            
-            # 获取原始尺寸
-            orig_width, orig_height = image.size
-            
-            # 计算缩放比例，保持原始比例
-            scale = min(max_size[0]/orig_width, max_size[1]/orig_height, 1.0)
-            
-            if scale != 1.0:
-                new_width = int(orig_width * scale)
-                new_height = int(orig_height * scale)
-                
-                # 确保图像在缩放前是RGB模式
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                # 使用高质量缩放
-                image = image.resize((new_width, new_height), Image.LANCZOS)
-            
-            return ImageTk.PhotoImage(image)
-        except Exception as e:
-            self.logger.error(f"Failed to create image preview: {str(e)}")
+        """创建自适应大小的图片预览, 缩放结果来自 ThumbnailCache"""
+        image = self.thumbnails.get(image_path, max_size)
+        if image is None:
             return None
+        return ImageTk.PhotoImage(image)
+
+    def prefetch_preview(self, color_info):
+        """在后台生成一次预览会用到的缩略图"""
+        for info in color_info.values():
+            self.thumbnails.prefetch(info['images'][:self.MAX_IMAGES_PER_COLOR], self.THUMBNAIL_SIZE)
 
     def skip_current_line(self):
         """跳过当前行"""
-        if self.current_updater:
+        if self.batch_pending:
+            self.record_batch_choice("SKIP")
+        elif self.current_updater:
             self.current_updater.skip_current_line()
             
     def confirm_color_selection(self, color):
         """确认颜色选择"""
-        if self.current_updater:
+        if self.batch_pending:
+            self.record_batch_choice(color)
+        elif self.current_updater:
             self.current_updater.set_selected_color(color)
+
+    def load_ambiguities(self):
+        """载入 scan 生成的待决定文件, 逐行显示供选择"""
+        if self.processing:
+            return
+        filename = filedialog.askopenfilename(filetypes=[("JSON files", "*.json")])
+        if not filename:
+            return
+        with open(filename, 'r', encoding='utf-8') as f:
+            self.batch_data = json.load(f)
+        self.batch_path = filename
+        self.batch_pending = [
+            (pair_index, key)
+            for pair_index, entry in enumerate(self.batch_data['pairs'])
+            for key, line in entry['ambiguous'].items()
+            if line['choice'] is None
+        ]
+        self.log_text.insert(tk.END, f"载入 {filename}, 待决定 {len(self.batch_pending)} 行\n")
+        self.show_next_ambiguity()
+
+    def show_next_ambiguity(self):
+        """显示下一条待决定的行, 全部完成后保存文件"""
+        if not self.batch_pending:
+            self.save_ambiguities()
+            messagebox.showinfo("信息", "全部待决定行已处理, 可以应用决定")
+            return
+        for next_pair, next_key in self.batch_pending[:self.PREFETCH_LINES + 1]:
+            self.prefetch_preview(self.batch_data['pairs'][next_pair]['ambiguous'][next_key]['colors'])
+        pair_index, key = self.batch_pending[0]
+        entry = self.batch_data['pairs'][pair_index]
+        line = entry['ambiguous'][key]
+        event = SimpleNamespace(
+            start=datetime.timedelta(seconds=line['start']),
+            end=datetime.timedelta(seconds=line['end']),
+            style=f"{line['style']} ({os.path.basename(entry['ass'])} 第{int(key) + 1}行, 剩余{len(self.batch_pending)})",
+            text=line['text']
+        )
+        self.update_preview_gui((event, line['colors']))
+
+    def record_batch_choice(self, color):
+        pair_index, key = self.batch_pending.pop(0)
+        self.batch_data['pairs'][pair_index]['ambiguous'][key]['choice'] = color
+        if len(self.batch_pending) % 20 == 0:
+            self.save_ambiguities()
+        self.show_next_ambiguity()
+
+    def save_ambiguities(self):
+        if self.batch_data is None:
+            return
+        with open(self.batch_path, 'w', encoding='utf-8') as f:
+            json.dump(self.batch_data, f, ensure_ascii=False, indent=1)
+
+    def apply_ambiguities(self):
+        """把自动决定和人工选择写入各ASS文件"""
+        if self.processing or self.batch_data is None:
+            return
+        self.save_ambiguities()
+        self.processing = True
+
+        def run():
+            try:
+                unresolved = apply_batch(self.batch_path, self.queue)
+                self.queue.put(("info", f"应用完成, 未决定 {unresolved} 行"))
+            except Exception as e:
+                self.queue.put(("error", f"应用失败: {str(e)}"))
+            finally:
+                self.processing = False
+
+        threading.Thread(target=run, daemon=True).start()
+        self.root.after(100, self.check_queue)
             
     def browse_file(self, file_type):
         """浏览并选择文件"""
         filetypes = {
             "xml": [("XML files", "*.xml")],
             "ass": [("ASS files", "*.ass")],
-            "output": [("ASS files", "*.ass")]
+            "output": [("ASS files", "*.ass")],
+            "json": [("JSON files", "*.json")]
         }
         
-        filename = filedialog.askopenfilename(filetypes=filetypes.get(file_type, [("All files", "*.*")]))
+        if file_type == "json":
+            filename = filedialog.asksaveasfilename(filetypes=filetypes["json"], defaultextension=".json")
+        else:
+            filename = filedialog.askopenfilename(filetypes=filetypes.get(file_type, [("All files", "*.*")]))
         if filename:
             if file_type == "xml":
                 self.xml_path.set(filename)
@@ -651,6 +1468,8 @@ class PGSASSColorGUI:
                 self.output_path.set(str(output.with_name(output.stem + '_colored' + output.suffix)))
             elif file_type == "output":
                 self.output_path.set(filename)
+            elif file_type == "json":
+                self.save_json.set(filename)
 
     def browse_directory(self):
         """浏览并选择目录"""
@@ -660,6 +1479,8 @@ class PGSASSColorGUI:
 
     def update_preview(self, color_info):
         """更新预览区域"""
+        # 在工作线程里就开始生成缩略图, Tk线程取队列时大多已完成
+        self.prefetch_preview(color_info[1])
         self.queue.put(("preview", color_info))
 
     def show_image(self, image_path):
@@ -717,28 +1538,30 @@ class PGSASSColorGUI:
         """处理文件的主要逻辑"""
         try:
             self.queue.put(("log", "开始分析XML文件和提取颜色..."))
-            analyzer = PGSColorAnalyzer(self.queue)
-            results = analyzer.parse_xml_and_analyze(self.xml_path.get(), self.images_dir.get())
-            
-            if not results:
-                self.queue.put(("error", "颜色分析失败"))
-                return
-                
-            temp_json = "temp_colors.json"
-            analyzer.save_results(results, temp_json)
+            if self.save_json.get():
+                analyzer = PGSColorAnalyzer(self.queue)
+                results = analyzer.parse_xml_and_analyze(self.xml_path.get(), self.images_dir.get())
+                if not results:
+                    self.queue.put(("error", "颜色分析失败"))
+                    return
+                analyzer.save_results(results, self.save_json.get())
+            else:
+                # 不保存JSON时边解析边匹配, 进度条显示ASS处理进度
+                analyzer = PGSColorAnalyzer()
+                results = analyzer.iter_events(self.xml_path.get(), self.images_dir.get())
             
             self.queue.put(("log", "开始更新ASS文件..."))
             self.current_updater = ASSColorUpdater(
                 self.ass_path.get(), 
-                temp_json, 
+                results, 
                 self.images_dir.get(),
                 self.queue,
-                self.update_preview
+                self.update_preview,
+                analyzer=analyzer
             )
             self.current_updater.update_dialogues_colors()
             self.current_updater.save(self.output_path.get())
             
-            os.remove(temp_json)
             self.queue.put(("info", "处理完成！"))
             
         except Exception as e:
@@ -772,7 +1595,129 @@ class PGSASSColorGUI:
         if self.processing:
             self.root.after(100, self.check_queue)
 
+def analyze_batch(xml_paths: List[str], images_dir: Optional[str] = None, output_dir: Optional[str] = None,
+                  workers: Optional[int] = None, use_cache: bool = True, columnar: bool = False) -> int:
+    """无界面批量分析多个XML, 每个XML输出 <名称>_colors.json (columnar 时为流式处理的 <名称>_colors.npz), 返回失败数"""
+    logger = logging.getLogger(__name__)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for xml_path in xml_paths:
+            xml_file = Path(xml_path)
+            analyzer = PGSColorAnalyzer()
+            logger.info(f"Analyzing {xml_file}")
+            if columnar:
+                output_path = Path(output_dir or xml_file.parent) / (xml_file.stem + '_colors.npz')
+                try:
+                    index = PGSEventIndex.from_events(analyzer.iter_events(
+                        str(xml_file), images_dir or str(xml_file.parent), workers, executor, use_cache
+                    ))
+                    index.video_height = analyzer.video_height
+                    index.save(str(output_path))
+                    logger.info(f"Results saved to {output_path}")
+                except Exception as e:
+                    logger.error(f"Analysis of {xml_file} failed: {str(e)}")
+                    failed += 1
+                continue
+            results = analyzer.parse_xml_and_analyze(str(xml_file), images_dir or str(xml_file.parent),
+                                                     workers, executor, use_cache)
+            if results is None:
+                failed += 1
+                continue
+            output_path = Path(output_dir or xml_file.parent) / (xml_file.stem + '_colors.json')
+            analyzer.save_results(results, str(output_path))
+    return failed
+
+
+def _scan_pair(pair: Dict, workers: Optional[int], executor: Optional[ProcessPoolExecutor], use_cache: bool) -> Dict:
+    analyzer = PGSColorAnalyzer()
+    events = analyzer.iter_events(pair['xml'], pair['images_dir'], workers, executor, use_cache)
+    updater = ASSColorUpdater(pair['ass'], events, pair['images_dir'], analyzer=analyzer)
+    pair['decisions'], pair['ambiguous'] = updater.scan_dialogues()
+    return pair
+
+
+def scan_batch(pairs: List[Tuple[str, str]], ambiguities_path: str, images_dir: Optional[str] = None,
+               workers: Optional[int] = None, use_cache: bool = True) -> Dict:
+    """
+    批量模式第一阶段: 对多组 (ASS, XML) 并行做自动判定, 把需要人工选择的行写入 ambiguities_path.
+    图片分析共用一个进程池
+    """
+    logger = logging.getLogger(__name__)
+    entries = []
+    for ass_path, xml_path in pairs:
+        output = Path(ass_path)
+        entries.append({
+            'ass': str(ass_path),
+            'xml': str(xml_path),
+            'images_dir': images_dir or str(Path(xml_path).parent),
+            'output': str(output.with_name(output.stem + '_colored' + output.suffix)),
+        })
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            ThreadPoolExecutor(max_workers=min(4, max(1, len(entries)))) as scanners:
+        entries = list(scanners.map(lambda entry: _scan_pair(entry, workers, executor, use_cache), entries))
+
+    data = {'version': 1, 'pairs': entries}
+    with open(ambiguities_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    for entry in entries:
+        logger.info(f"{entry['ass']}: {len(entry['decisions'])} automatic, {len(entry['ambiguous'])} to resolve")
+    logger.info(f"Ambiguities saved to {ambiguities_path}")
+    return data
+
+
+def apply_batch(ambiguities_path: str, queue=None) -> int:
+    """批量模式最后阶段: 应用自动决定和已解决的选择, 写出各ASS文件, 返回仍未解决的行数"""
+    logger = logging.getLogger(__name__)
+    with open(ambiguities_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    unresolved = 0
+    for entry in data['pairs']:
+        decisions = dict(entry['decisions'])
+        for key, line in entry['ambiguous'].items():
+            if line['choice'] is None:
+                unresolved += 1
+            elif line['choice'] != "SKIP":
+                decisions[key] = line['choice']
+        updater = ASSColorUpdater(entry['ass'], [], entry['images_dir'], queue)
+        updater.apply_decisions(decisions)
+        updater.save(entry['output'])
+        logger.info(f"Saved {entry['output']} ({len(decisions)} lines colored)")
+    if unresolved:
+        logger.warning(f"{unresolved} ambiguous lines were left unresolved")
+    return unresolved
+
+
 def main():
+    if len(sys.argv) > 1:
+        parser = argparse.ArgumentParser(description="PGS/ASS 字幕颜色处理工具, 不带参数时启动图形界面")
+        subparsers = parser.add_subparsers(dest='command', required=True)
+        analyze_parser = subparsers.add_parser('analyze', help="批量分析BDN XML, 输出颜色JSON")
+        analyze_parser.add_argument('xml', nargs='+', help="BDN XML文件")
+        analyze_parser.add_argument('--images-dir', help="图片目录, 默认为XML所在目录")
+        analyze_parser.add_argument('--output-dir', help="JSON输出目录, 默认为XML所在目录")
+        analyze_parser.add_argument('--workers', type=int, help="进程数, 默认为CPU核心数")
+        analyze_parser.add_argument('--no-cache', action='store_true', help="不读写图片目录下的颜色缓存")
+        analyze_parser.add_argument('--npz', action='store_true', help="流式解析并输出列式 .npz 而不是JSON")
+        scan_parser = subparsers.add_parser('scan', help="批量自动判定, 输出待人工决定的行")
+        scan_parser.add_argument('--pair', nargs=2, action='append', required=True, metavar=('ASS', 'XML'),
+                                 help="一组ASS和BDN XML, 可重复")
+        scan_parser.add_argument('-o', '--output', default='ambiguities.json', help="待决定行的JSON文件")
+        scan_parser.add_argument('--images-dir', help="图片目录, 默认为各XML所在目录")
+        scan_parser.add_argument('--workers', type=int, help="进程数, 默认为CPU核心数")
+        scan_parser.add_argument('--no-cache', action='store_true', help="不读写图片目录下的颜色缓存")
+        apply_parser = subparsers.add_parser('apply', help="应用 scan 结果和已解决的选择, 写出ASS")
+        apply_parser.add_argument('ambiguities', help="scan 生成的JSON文件")
+        args = parser.parse_args()
+        if args.command == 'scan':
+            scan_batch(args.pair, args.output, args.images_dir, args.workers, not args.no_cache)
+        elif args.command == 'apply':
+            apply_batch(args.ambiguities)
+        else:
+            sys.exit(1 if analyze_batch(args.xml, args.images_dir, args.output_dir, args.workers,
+                                        not args.no_cache, args.npz) else 0)
+        return
+
     app = PGSASSColorGUI()
     app.root.mainloop()
 
@@ -1,12 +1,21 @@
 import sys
+import os
+import argparse
 import subprocess
 import threading
-import tkinter as tk
-from tkinter import ttk, scrolledtext
+import re
 import shlex
 import hashlib
 import colorsys
 import queue
+import codecs
+import time
+
+try:
+    import tkinter as tk
+    from tkinter import ttk, scrolledtext
+except ImportError:  # headless nodes may not have Tk at all
+    tk = None
 
 class LogWindow:
     def __init__(self, command, color):
@@ -45,13 +54,42 @@ class LogWindow:
         self.log_queue.put(text)
 
     def update_log(self):
+        lines = []
         while not self.log_queue.empty():
-            text = self.log_queue.get()
-            self.text.insert('end', text + '\n')
+            lines.append(self.log_queue.get())
+        if lines:
+            self.text.insert('end', '\n'.join(lines) + '\n')
             if self.autoscroll:
                 self.text.see('end')
         self.window.after(100, self.update_log)
 
+class HeadlessLog:
+    """Writes one encoder's output prefixed to stdout, or to its own log file."""
+
+    stdout_lock = threading.Lock()
+
+    def __init__(self, index, command, log_dir=None):
+        self.name = os.path.basename(shlex.split(command)[0])
+        self.prefix = f"[{index}:{self.name}] "
+        self.file = None
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            self.file = open(os.path.join(log_dir, f"encoder_{index}_{self.name}.log"), 'w', encoding='utf-8')
+        self.append_log(f"Command: {command}")
+
+    def append_log(self, text):
+        if self.file:
+            self.file.write(text + '\n')
+            self.file.flush()
+        else:
+            with self.stdout_lock:
+                sys.stdout.write(self.prefix + text + '\n')
+                sys.stdout.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
 def get_color_mapping(commands):
     hash_values = {
         cmd: int(hashlib.sha1(cmd.encode()).hexdigest(), 16) / (2**160)
@@ -70,40 +108,525 @@ def get_color_mapping(commands):
         colors[cmd] = hex_color
     return colors
 
-def output_reader(proc, window):
+class EncoderOutput:
+    """
+    Splits encoder output into lines. Carriage-return progress updates are
+    collapsed to at most progress_rate lines per second, and the encoder's
+    final "encoded N frames" summary is remembered.
+    """
+
+    SUMMARY = re.compile(r'encoded (\d+) frames(?: in ([\d.]+)s)?[ ,(]+([\d.]+) fps\)?, ([\d.]+) kb/s')
+
+    def __init__(self, log, progress_rate=2.0):
+        self.log = log
+        self.interval = 1.0 / progress_rate if progress_rate > 0 else 0.0
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self.pending = ''
+        self.last_progress = 0.0
+        self.summary = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    def feed(self, data):
+        self.pending += self.decoder.decode(data)
+        while True:
+            match = re.search(r'\r\n|\r|\n', self.pending)
+            if not match:
+                break
+            line = self.pending[:match.start()].strip()
+            self.pending = self.pending[match.end():]
+            if not line:
+                continue
+            if match.group() == '\r':
+                now = time.time()
+                if now - self.last_progress < self.interval:
+                    continue
+                self.last_progress = now
+            self.emit(line)
+
+    def emit(self, line):
+        summary = self.SUMMARY.search(line)
+        if summary:
+            self.summary = summary
+        self.log(line)
+
+    def close(self):
+        self.pending += self.decoder.decode(b'', final=True)
+        if self.pending.strip():
+            self.emit(self.pending.strip())
+        self.pending = ''
+        self.end_time = time.time()
+
+    def summary_line(self, returncode):
+        elapsed = (self.end_time or time.time()) - self.start_time
+        text = f"exit {returncode}, elapsed {time.strftime('%H:%M:%S', time.gmtime(elapsed))}"
+        if self.summary:
+            frames, _, fps, bitrate = self.summary.groups()
+            text += f", {frames} frames, {float(fps):.2f} fps, {float(bitrate):.2f} kb/s"
+        return text
+
+def output_reader(proc, output):
     try:
         while True:
-            output = proc.stdout.read(1024)
-            if not output:
+            data = proc.stdout.read(65536)
+            if not data:
                 break
-            window.append_log(output.decode('utf-8', errors='ignore').strip())
+            output.feed(data)
     except Exception as e:
         print(f"Error reading output: {e}")
+    finally:
+        output.close()
 
-def copy_stdin(processes):
-    while True:
-        chunk = sys.stdin.buffer.read(10240*1024)
-        if not chunk:
-            break
-        for proc in processes:
+CHUNK_SIZE = 4 * 1024 * 1024
+
+class Y4MStream:
+    """Minimal YUV4MPEG2 demuxer: parses the stream header and yields one frame at a time."""
+
+    SUBSAMPLING = {'420': (1, 1), '422': (1, 0), '444': (0, 0), '411': (2, 0), 'mono': None}
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.header = stream.readline()
+        tokens = self.header.rstrip(b'\n').split(b' ')
+        if tokens[0] != b'YUV4MPEG2':
+            raise ValueError("Input is not a YUV4MPEG2 stream")
+        self.params = [token.decode() for token in tokens[1:] if token]
+
+        fields = {param[0]: param[1:] for param in self.params}
+        self.width = int(fields['W'])
+        self.height = int(fields['H'])
+        colorspace = fields.get('C', '420jpeg')
+        match = re.match(r'(mono|420|422|444|411)(alpha|jpeg|paldv|mpeg2)?p?(\d+)?$', colorspace)
+        if not match:
+            raise ValueError(f"Unsupported y4m colorspace: {colorspace}")
+        self.subsampling = self.SUBSAMPLING[match.group(1)]
+        self.bytes_per_sample = 2 if match.group(3) and int(match.group(3)) > 8 else 1
+        self.num_planes = 1 if self.subsampling is None else 3
+        if match.group(2) == 'alpha':
+            self.num_planes = 4
+        self.length = int(fields['X'][len('LENGTH='):]) if fields.get('X', '').startswith('LENGTH=') else None
+
+        self.frame_size = sum(w * h for w, h in self.plane_sizes(self.width, self.height)) * self.bytes_per_sample
+
+    def plane_sizes(self, width, height):
+        sizes = [(width, height)]
+        if self.subsampling is not None:
+            sw, sh = self.subsampling
+            chroma = ((width + (1 << sw) - 1) >> sw, (height + (1 << sh) - 1) >> sh)
+            sizes += [chroma, chroma]
+        if self.num_planes == 4:
+            sizes.append((width, height))
+        return sizes
+
+    def frames(self):
+        while True:
+            frame_header = self.stream.readline()
+            if not frame_header:
+                return
+            if not frame_header.startswith(b'FRAME'):
+                raise ValueError("Lost y4m frame sync")
+            data = self.stream.read(self.frame_size)
+            if len(data) < self.frame_size:
+                return
+            yield frame_header, memoryview(data)
+
+    def crop(self, data, crop):
+        """Crop one frame; x/y/width/height must be multiples of the chroma subsampling."""
+        width, height, x, y = crop
+        bps = self.bytes_per_sample
+        rows = []
+        offset = 0
+        for index, (plane_w, plane_h) in enumerate(self.plane_sizes(self.width, self.height)):
+            sw, sh = (0, 0) if index in (0, 3) or self.subsampling is None else self.subsampling
+            px, py, pw, ph = x >> sw, y >> sh, width >> sw, height >> sh
+            stride = plane_w * bps
+            for row in range(py, py + ph):
+                start = offset + row * stride + px * bps
+                rows.append(data[start:start + pw * bps])
+            offset += stride * plane_h
+        return b''.join(rows)
+
+    def check_crop(self, crop):
+        width, height, x, y = crop
+        sw, sh = self.subsampling or (0, 0)
+        if any(v % (1 << sw) for v in (width, x)) or any(v % (1 << sh) for v in (height, y)):
+            raise ValueError(f"Crop {width}:{height}:{x}:{y} is not aligned to the chroma subsampling")
+        if width <= 0 or height <= 0 or x + width > self.width or y + height > self.height:
+            raise ValueError(f"Crop {width}:{height}:{x}:{y} is outside the {self.width}x{self.height} frame")
+
+class FrameSelection:
+    """Which frames of the y4m input an encoder gets: [start, end) every step-th frame, optionally cropped."""
+
+    def __init__(self, start=0, end=None, step=1, crop=None):
+        self.start = start
+        self.end = end
+        self.step = step
+        self.crop = crop
+
+    def wants(self, n):
+        return n >= self.start and (self.end is None or n < self.end) and (n - self.start) % self.step == 0
+
+    def done(self, n):
+        return self.end is not None and n >= self.end
+
+    def header(self, y4m):
+        params = []
+        for param in y4m.params:
+            if param[0] == 'W' and self.crop:
+                param = f"W{self.crop[0]}"
+            elif param[0] == 'H' and self.crop:
+                param = f"H{self.crop[1]}"
+            elif param.startswith('XLENGTH=') and y4m.length is not None:
+                end = y4m.length if self.end is None else min(self.end, y4m.length)
+                param = f"XLENGTH={len(range(self.start, end, self.step))}"
+            params.append(param)
+        return ('YUV4MPEG2 ' + ' '.join(params) + '\n').encode()
+
+class Consumer:
+    """One encoder fed by its own writer thread from a bounded buffer of shared chunks."""
+
+    def __init__(self, index, command, proc, engine, log, selection=None):
+        self.index = index
+        self.command = command
+        self.proc = proc
+        self.engine = engine
+        self.log = log
+        self.selection = selection
+        self.finished = False
+        self.fd = proc.stdin.fileno()
+        self.buffer = queue.Queue(maxsize=engine.buffer_chunks)
+        self.sink = self.fd
+        self.spool_file = None
+        self.bytes_written = 0
+        self.writer = None
+
+    @property
+    def attached(self):
+        return self.sink == self.fd
+
+    def start(self):
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def feed(self, view):
+        self.buffer.put(view)
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.buffer.put(None)
+
+    def write_loop(self):
+        while True:
+            item = self.buffer.get()
+            if item is None:
+                break
+            # y4m frames are queued as (frame header, frame data)
+            for view in (item if isinstance(item, tuple) else (item,)):
+                self.write(view)
+        self.close()
+
+    def write(self, view):
+        """Write one chunk to the encoder, or to wherever the failure policy redirected it."""
+        if self.sink is None:
+            return
+        if self.spool_file:
+            self.spool_file.write(view)
+            return
+        try:
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+                self.bytes_written += written
+        except OSError as e:
+            self.engine.consumer_failed(self, e, view)
+
+    def detach(self):
+        self.sink = None
+        self.close_stdin()
+
+    def spool(self, path, pending):
+        self.spool_file = open(path, 'wb')
+        self.sink = self.spool_file
+        self.spool_file.write(pending)
+        self.close_stdin()
+
+    def close_stdin(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+    def close(self):
+        if self.spool_file:
+            self.spool_file.close()
+        self.close_stdin()
+
+class FanoutEngine:
+    """
+    Copies stdin to every consumer. Chunks are immutable and shared between
+    consumers, each consumer drains its own bounded buffer, so the reader
+    only waits when the slowest encoder falls a whole buffer behind.
+    """
+
+    def __init__(self, policy='detach', buffer_bytes=64 * 1024 * 1024, spool_dir='.'):
+        self.policy = policy
+        self.buffer_chunks = max(1, buffer_bytes // CHUNK_SIZE)
+        self.spool_dir = spool_dir
+        self.consumers = []
+        self.aborted = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_consumer(self, command, proc, log=print, selection=None):
+        consumer = Consumer(len(self.consumers), command, proc, self, log, selection)
+        self.consumers.append(consumer)
+        return consumer
+
+    def consumer_failed(self, consumer, error, pending):
+        with self.lock:
+            if self.policy == 'abort':
+                consumer.log(f"Encoder {consumer.index} failed ({error}), aborting all encoders")
+                consumer.detach()
+                self.abort()
+            elif self.policy == 'spool':
+                path = os.path.join(self.spool_dir, f"tee_spool_{consumer.index}.bin")
+                consumer.log(f"Encoder {consumer.index} failed ({error}) after {consumer.bytes_written} bytes, "
+                             f"spooling the rest of its input to {path}")
+                consumer.spool(path, pending)
+            else:
+                consumer.log(f"Encoder {consumer.index} failed ({error}) after {consumer.bytes_written} bytes, detached")
+                consumer.detach()
+
+    def abort(self):
+        self.aborted.set()
+        for consumer in self.consumers:
             try:
-                proc.stdin.write(chunk)
-                proc.stdin.flush()
-            except:
+                consumer.proc.terminate()
+            except OSError:
                 pass
 
-    for proc in processes:
+    def run(self, stream=None):
+        stream = stream or sys.stdin.buffer
+        for consumer in self.consumers:
+            consumer.start()
+        if any(consumer.selection for consumer in self.consumers):
+            return self.run_y4m(stream)
+        try:
+            while not self.aborted.is_set():
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                view = memoryview(chunk)
+                for consumer in self.consumers:
+                    consumer.feed(view)
+        finally:
+            for consumer in self.consumers:
+                consumer.finish()
+            for consumer in self.consumers:
+                consumer.writer.join()
+
+    def run_y4m(self, stream):
+        """Frame-aware copy: every encoder gets only its own frame range, step and crop."""
+        try:
+            y4m = Y4MStream(stream)
+            for consumer in self.consumers:
+                selection = consumer.selection or FrameSelection()
+                if selection.crop:
+                    y4m.check_crop(selection.crop)
+                consumer.feed(memoryview(selection.header(y4m)))
+
+            for n, (frame_header, data) in enumerate(y4m.frames()):
+                if self.aborted.is_set():
+                    break
+                active = False
+                for consumer in self.consumers:
+                    selection = consumer.selection or FrameSelection()
+                    if consumer.finished:
+                        continue
+                    if selection.done(n):
+                        # close its input early so the encoder can finish
+                        consumer.finish()
+                        continue
+                    active = True
+                    if selection.wants(n):
+                        frame = y4m.crop(data, selection.crop) if selection.crop else data
+                        consumer.feed((frame_header, frame))
+                if not active:
+                    break
+        finally:
+            for consumer in self.consumers:
+                consumer.finish()
+            for consumer in self.consumers:
+                consumer.writer.join()
+
+    def run_splice(self, fd=None):
+        """
+        Linux fast path: move the input into a private pipe with splice(2),
+        duplicate it to the encoders with tee(2) and splice it into the last
+        encoder, so data never enters user space unless a tee comes up short.
+        Returns False when the fast path is not available.
+        """
+        import ctypes
+        import fcntl
+        import stat
+
+        fd = sys.stdin.fileno() if fd is None else fd
+        if not hasattr(os, 'splice') or not stat.S_ISFIFO(os.fstat(fd).st_mode):
+            return False
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            tee = libc.tee
+        except (OSError, AttributeError):
+            return False
+        tee.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+        tee.restype = ctypes.c_ssize_t
+
+        pipe_r, pipe_w = os.pipe()
+        pipe_size = CHUNK_SIZE
         try:
-            proc.stdin.close()
-        except:
+            pipe_size = fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, CHUNK_SIZE)
+            for consumer in self.consumers:
+                fcntl.fcntl(consumer.fd, fcntl.F_SETPIPE_SZ, CHUNK_SIZE)
+        except (OSError, AttributeError):
             pass
 
+        try:
+            while not self.aborted.is_set():
+                length = os.splice(fd, pipe_w, pipe_size)
+                if length == 0:
+                    break
+
+                attached = [c for c in self.consumers if c.attached]
+                last = attached.pop() if attached else None
+                short = {c: 0 for c in self.consumers if c.spool_file}
+                for consumer in attached:
+                    copied = tee(pipe_r, consumer.fd, length, 0)
+                    if copied < 0:
+                        copied = 0
+                        error = OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+                        self.consumer_failed(consumer, error, b'')
+                        if not consumer.spool_file:
+                            continue
+                    if copied < length:
+                        consumer.bytes_written += copied
+                        short[consumer] = copied
+                    else:
+                        consumer.bytes_written += length
+
+                if short or last is None:
+                    data = bytearray()
+                    while len(data) < length:
+                        data += os.read(pipe_r, length - len(data))
+                    data = memoryview(data)
+                    for consumer, offset in short.items():
+                        consumer.write(data[offset:])
+                    if last:
+                        last.write(data)
+                else:
+                    moved = 0
+                    try:
+                        while moved < length:
+                            moved += os.splice(pipe_r, last.fd, length - moved)
+                        last.bytes_written += moved
+                    except OSError as e:
+                        last.bytes_written += moved
+                        rest = memoryview(os.read(pipe_r, length - moved))
+                        self.consumer_failed(last, e, rest)
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+            for consumer in self.consumers:
+                consumer.close()
+        return True
+
+def start_encoder(command):
+    return subprocess.Popen(
+        shlex.split(command),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=0
+    )
+
+def run_headless(commands, engine, selections, copy_stdin, log_dir=None, progress_rate=2.0):
+    """Run without Tk: prefixed output on stdout or per-encoder log files, then one summary line per encoder."""
+    encoders = []
+    for index, cmd in enumerate(commands):
+        log = HeadlessLog(index, cmd, log_dir)
+        proc = start_encoder(cmd)
+        output = EncoderOutput(log.append_log, progress_rate)
+        engine.add_consumer(cmd, proc, log.append_log, selections.get(index))
+        thread = threading.Thread(target=output_reader, args=(proc, output), daemon=True)
+        thread.start()
+        encoders.append((log, proc, output, thread))
+
+    try:
+        copy_stdin()
+        for log, proc, output, thread in encoders:
+            proc.wait()
+            thread.join()
+    except KeyboardInterrupt:
+        engine.abort()
+        for log, proc, output, thread in encoders:
+            proc.wait()
+
+    for log, proc, output, thread in encoders:
+        with HeadlessLog.stdout_lock:
+            print(f"{log.prefix}{output.summary_line(proc.returncode)}", flush=True)
+        log.close()
+
+    return max((abs(proc.returncode) for log, proc, output, thread in encoders), default=0)
+
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python script.py 'encoder1 args' 'encoder2 args' ...")
-        return
+    parser = argparse.ArgumentParser(description="Run multiple encoders on one input stream, pre-processing only once.")
+    parser.add_argument('commands', nargs='+', help="Encoder commands, e.g. 'x265 --y4m --input - -o a.hevc'.")
+    parser.add_argument('--on-error', choices=['abort', 'detach', 'spool'], default='detach',
+                        help="What to do when an encoder dies: stop everything, drop it, or save the rest of its input to disk.")
+    parser.add_argument('--spool-dir', type=str, default='.', help="Directory for spooled input of dead encoders.")
+    parser.add_argument('--buffer-mb', type=int, default=64, help="Input buffered per encoder before the reader waits for it.")
+    parser.add_argument('--frames', action='append', default=[], metavar='N=START:END[:STEP]',
+                        help="Give encoder N (0-based) only frames START..END-1 of a y4m input, every STEP-th frame. END may be empty.")
+    parser.add_argument('--crop', action='append', default=[], metavar='N=W:H:X:Y',
+                        help="Crop the y4m frames sent to encoder N.")
+    parser.add_argument('--splice', action='store_true',
+                        help="Linux only: copy with tee(2)/splice(2) when stdin is a pipe. Encoders are paced by the kernel pipe buffers.")
+    parser.add_argument('--headless', action='store_true', help="Run without GUI, printing prefixed encoder output to stdout.")
+    parser.add_argument('--log-dir', type=str, help="With --headless, write each encoder's output to its own file in this directory.")
+    parser.add_argument('--progress-rate', type=float, default=2.0,
+                        help="Maximum progress updates per second shown for each encoder.")
+
+    args = parser.parse_args()
+
+    commands = args.commands
+    selections = {}
+    try:
+        for spec in args.frames:
+            index, frame_range = spec.split('=', 1)
+            parts = frame_range.split(':')
+            selection = selections.setdefault(int(index), FrameSelection())
+            selection.start = int(parts[0] or 0)
+            selection.end = int(parts[1]) if len(parts) > 1 and parts[1] else None
+            selection.step = int(parts[2]) if len(parts) > 2 and parts[2] else 1
+        for spec in args.crop:
+            index, crop = spec.split('=', 1)
+            selections.setdefault(int(index), FrameSelection()).crop = tuple(int(v) for v in crop.split(':'))
+    except ValueError:
+        parser.error("Invalid --frames/--crop specification")
+    if any(index >= len(commands) for index in selections):
+        parser.error("--frames/--crop refers to an encoder that does not exist")
+    engine = FanoutEngine(args.on_error, args.buffer_mb * 1024 * 1024, args.spool_dir)
+
+    def copy_stdin():
+        # frame selection needs the y4m parser, so it cannot use the splice path
+        if selections or not (args.splice and engine.run_splice()):
+            engine.run()
+
+    if args.headless:
+        sys.exit(run_headless(commands, engine, selections, copy_stdin, args.log_dir, args.progress_rate))
+
+    if tk is None:
+        parser.error("Tk is not available, use --headless")
 
-    commands = sys.argv[1:]
     processes = []
     windows = {}
 
@@ -116,25 +639,19 @@ def main():
         window = LogWindow(cmd, colors[cmd])
         windows[cmd] = window
 
-        proc = subprocess.Popen(
-            shlex.split(cmd),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            bufsize=0
-        )
+        proc = start_encoder(cmd)
         processes.append(proc)
+        engine.add_consumer(cmd, proc, window.append_log, selections.get(len(processes) - 1))
 
         thread = threading.Thread(
             target=output_reader,
-            args=(proc, window),
+            args=(proc, EncoderOutput(window.append_log, args.progress_rate)),
             daemon=True
         )
         thread.start()
 
     copy_thread = threading.Thread(
         target=copy_stdin,
-        args=(processes,),
         daemon=True
     )
     copy_thread.start()